@@ -1,16 +1,25 @@
 import os
 import json
+import asyncio
+from functools import partial
 from contextlib import asynccontextmanager
 
 from urllib.parse import urlencode
 
-from .http import connect_unix, connect_tcp
+from .http import connect_unix, connect_tcp, open_unix, open_tcp
+from .http import ConnectionPool
 from .auth import read_config, server_name, resolve_auth, encode_header
 from .utils import cached_property
 
 
 CHUNK_SIZE = 65535
 
+POOL_SIZE = 10
+IDLE_TIMEOUT = 30
+
+_IMAGES = '/images/json'
+_CONTAINERS = '/containers/json'
+
 _TCP_PROTO = 'tcp://'
 _UNIX_PROTO = 'unix://'
 _DOCKER_HOST = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
@@ -20,15 +29,41 @@ if _DOCKER_HOST.startswith(_TCP_PROTO):
 
     def connect_docker(**kwargs):
         return connect_tcp(_HOST, _PORT, **kwargs)
+
+    def open_docker():
+        return open_tcp(_HOST, _PORT)
 elif _DOCKER_HOST.startswith(_UNIX_PROTO):
     _PATH = _DOCKER_HOST[len(_UNIX_PROTO):]
 
     def connect_docker(**kwargs):
         return connect_unix(_PATH, **kwargs)
+
+    def open_docker():
+        return open_unix(_PATH)
 else:
     raise RuntimeError(f'Invalid DOCKER_HOST environ variable: {_DOCKER_HOST}')
 
 
+def _filters_param(filters):
+    return json.dumps({
+        key: [value] if isinstance(value, str) else list(value)
+        for key, value in filters.items()
+    }, sort_keys=True)
+
+
+async def _send_file(stream, file):
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if len(chunk) == CHUNK_SIZE:
+            await stream.send_data(chunk, end_stream=False)
+        else:
+            if chunk:
+                await stream.send_data(chunk)
+            else:
+                await stream.end()
+            break
+
+
 async def _recv_json(stream, response):
     content_type = response.headers.get(b'content-type')
     assert content_type == b'application/json', response
@@ -44,48 +79,91 @@ async def _recv_json(stream, response):
     else:
         assert False, response
 
-    return json.loads(data.decode('utf-8'))
+    return json.loads(data)
 
 
-async def _request_json(method, path, data=None, *, _ok_statuses=None):
-    if _ok_statuses is None:
-        _ok_statuses = frozenset({200, 201, 204})
-    async with connect_docker() as stream:
-        headers = [
-            ('Host', 'localhost'),
-            ('Connection', 'close'),
-        ]
-        if data is not None:
-            json_data = json.dumps(data).encode('utf-8')
-            headers.append(('Content-Type', 'application/json'))
-            headers.append(('Content-Length', str(len(json_data))))
-        await stream.send_request(method, path, headers,
-                                  end_stream=(data is None))
-        if data is not None:
-            await stream.send_data(json_data)
-        response = await stream.recv_response()
-        if response.status_code == 204:
-            return None
-        if response.status_code in _ok_statuses:
-            return await _recv_json(stream, response)
-        else:
-            raise response.error()
-
-
-async def _get_json(path, *, _ok_statuses=None):
-    return await _request_json('GET', path, _ok_statuses=_ok_statuses)
-
-
-async def _post_json(path, data=None, *, _ok_statuses=None):
-    return await _request_json('POST', path, data=data,
-                               _ok_statuses=_ok_statuses)
-
-
-async def _delete_json(path, *, _ok_statuses=None):
-    return await _request_json('DELETE', path, _ok_statuses=_ok_statuses)
+class Docker:
 
+    def __init__(self, *, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self._pool = ConnectionPool(open_docker, size=pool_size,
+                                    idle_timeout=idle_timeout)
+        self._cache = {}
+
+    def close(self):
+        self._pool.close()
+
+    async def _request_json(self, method, path, data=None, *,
+                            _ok_statuses=None):
+        if _ok_statuses is None:
+            _ok_statuses = frozenset({200, 201, 204})
+        async with self._pool.connect() as stream:
+            headers = [('Host', 'localhost')]
+            if data is not None:
+                json_data = json.dumps(data).encode('utf-8')
+                headers.append(('Content-Type', 'application/json'))
+                headers.append(('Content-Length', str(len(json_data))))
+            await stream.send_request(method, path, headers,
+                                      end_stream=(data is None))
+            if data is not None:
+                await stream.send_data(json_data)
+            response = await stream.recv_response()
+            if (
+                response.status_code == 204
+                or response.headers.get(b'content-length') == b'0'
+            ):
+                return None
+            if response.status_code in _ok_statuses:
+                return await _recv_json(stream, response)
+            else:
+                raise response.error()
 
-class Docker:
+    async def _iter_json(self, path):
+        async with self._pool.connect() as stream:
+            await stream.send_request('GET', path, [('Host', 'localhost')])
+            response = await stream.recv_response()
+            if response.status_code != 200:
+                raise response.error()
+            content_type = response.headers.get(b'content-type')
+            assert content_type == b'application/json', response
+            async for item in stream.recv_json_array():
+                yield item
+
+    async def _get_json_array(self, path):
+        return [item async for item in self._iter_json(path)]
+
+    async def _get_json(self, path, *, _ok_statuses=None):
+        return await self._request_json('GET', path,
+                                        _ok_statuses=_ok_statuses)
+
+    async def _post_json(self, path, data=None, *, _ok_statuses=None):
+        return await self._request_json('POST', path, data=data,
+                                        _ok_statuses=_ok_statuses)
+
+    async def _delete_json(self, path, *, _ok_statuses=None):
+        return await self._request_json('DELETE', path,
+                                        _ok_statuses=_ok_statuses)
+
+    def _cache_discard(self, path, task):
+        if task.cancelled() or task.exception() is not None:
+            if self._cache.get(path) is task:
+                del self._cache[path]
+
+    async def _get_cached_json(self, path):
+        """Concurrent and repeated requests to the same path are merged
+        into a single request, results are shared between callers and
+        should not be modified
+        """
+        task = self._cache.get(path)
+        if task is None:
+            task = self._cache[path] = asyncio.ensure_future(
+                self._get_json_array(path),
+            )
+            task.add_done_callback(partial(self._cache_discard, path))
+        return await asyncio.shield(task)
+
+    def _invalidate(self, prefix):
+        for path in [p for p in self._cache if p.startswith(prefix)]:
+            del self._cache[path]
 
     @cached_property
     def _docker_config(self):
@@ -100,21 +178,33 @@ class Docker:
         else:
             return None
 
-    async def images(self):
-        return await _get_json('/images/json')
+    async def images(self, *, filters=None):
+        uri = _IMAGES
+        if filters:
+            uri += '?' + urlencode({'filters': _filters_param(filters)})
+        return await self._get_cached_json(uri)
+
+    async def iter_images(self, *, filters=None):
+        uri = _IMAGES
+        if filters:
+            uri += '?' + urlencode({'filters': _filters_param(filters)})
+        async for image in self._iter_json(uri):
+            yield image
 
     async def create_container(self, spec, *, params=None):
         uri = '/containers/create'
         if params:
             uri += '?' + urlencode(params)
-        return await _post_json(uri, spec)
+        container = await self._post_json(uri, spec)
+        self._invalidate(_CONTAINERS)
+        return container
 
     async def resize(self, id_, *, params=None):
         assert isinstance(id_, str), id_
         uri = '/containers/{id}/resize'.format(id=id_)
         if params:
             uri += '?' + urlencode(params)
-        async with connect_docker() as stream:
+        async with self._pool.connect() as stream:
             await stream.send_request('POST', uri, [
                 ('Host', 'localhost'),
             ])
@@ -129,13 +219,13 @@ class Docker:
         uri = '/containers/{id}/start'.format(id=id_)
         if params:
             uri += '?' + urlencode(params)
-        async with connect_docker() as stream:
+        async with self._pool.connect() as stream:
             await stream.send_request('POST', uri, [
                 ('Host', 'localhost'),
             ])
             response = await stream.recv_response()
             if response.status_code == 204:
-                pass
+                self._invalidate(_CONTAINERS)
             elif response.status_code == 304:
                 pass
             else:
@@ -144,7 +234,7 @@ class Docker:
     async def exec_create(self, id_, spec):
         assert isinstance(id_, str), id_
         uri = '/containers/{id}/exec'.format(id=id_)
-        return await _post_json(uri, spec)
+        return await self._post_json(uri, spec)
 
     @asynccontextmanager
     async def exec_start(self, id_, spec, stdin_proto, stdout_proto):
@@ -171,7 +261,7 @@ class Docker:
     async def exec_inspect(self, id_):
         assert isinstance(id_, str), id_
         uri = '/exec/{id}/json'.format(id=id_)
-        return await _get_json(uri)
+        return await self._get_json(uri)
 
     @asynccontextmanager
     async def attach(self, id_, stdin_proto, stdout_proto, *, params=None):
@@ -198,13 +288,13 @@ class Docker:
         uri = '/containers/{id}'.format(id=id_)
         if params:
             uri += '?' + urlencode(params)
-        async with connect_docker() as stream:
+        async with self._pool.connect() as stream:
             await stream.send_request('DELETE', uri, [
                 ('Host', 'localhost'),
             ])
             response = await stream.recv_response()
             if response.status_code == 204:
-                pass
+                self._invalidate(_CONTAINERS)
             else:
                 raise response.error()
 
@@ -218,12 +308,38 @@ class Docker:
             if auth_header:
                 headers.append(('X-Registry-Auth', auth_header))
 
-        async with connect_docker() as stream:
+        async with self._pool.connect() as stream:
             await stream.send_request('POST', uri, headers)
             response = await stream.recv_response()
             if response.status_code == 200:
-                async for chunk in stream.recv_data_chunked():
-                    yield chunk
+                try:
+                    async for chunk in stream.recv_data_chunked():
+                        yield chunk
+                finally:
+                    self._invalidate(_IMAGES)
+            else:
+                raise response.error()
+
+    async def build(self, context, *, params):
+        """Builds image using Dockerfile from the `context` tar archive"""
+        uri = '/build'
+        if params:
+            uri += '?' + urlencode(params)
+        headers = [
+            ('Host', 'localhost'),
+            ('Content-Type', 'application/x-tar'),
+            ('transfer-encoding', 'chunked'),
+        ]
+        async with self._pool.connect() as stream:
+            await stream.send_request('POST', uri, headers, end_stream=False)
+            await _send_file(stream, context)
+            response = await stream.recv_response()
+            if response.status_code == 200:
+                try:
+                    async for chunk in stream.recv_data_chunked():
+                        yield chunk
+                finally:
+                    self._invalidate(_IMAGES)
             else:
                 raise response.error()
 
@@ -236,7 +352,7 @@ class Docker:
         if auth_header:
             headers.append(('X-Registry-Auth', auth_header))
 
-        async with connect_docker() as stream:
+        async with self._pool.connect() as stream:
             await stream.send_request('POST', uri, headers)
             response = await stream.recv_response()
             if response.status_code == 200:
@@ -245,47 +361,67 @@ class Docker:
             else:
                 raise response.error()
 
-    async def containers(self, *, params):
-        uri = '/containers/json'
+    async def containers(self, *, params=None, filters=None):
+        uri = _CONTAINERS
+        if filters:
+            params = dict(params or {}, filters=_filters_param(filters))
         if params:
             uri += '?' + urlencode(params)
-        return await _get_json(uri)
+        return await self._get_cached_json(uri)
 
     async def remove_image(self, name):
         uri = '/images/{name}'.format(name=name)
-        return await _delete_json(uri)
+        result = await self._delete_json(uri)
+        self._invalidate(_IMAGES)
+        return result
 
     async def wait(self, id_):
         assert isinstance(id_, str), id_
         uri = '/containers/{id}/wait'.format(id=id_)
-        return await _post_json(uri)
+        try:
+            return await self._post_json(uri)
+        finally:
+            # container is not running anymore
+            self._invalidate(_CONTAINERS)
 
     async def stop(self, id_, *, params):
         assert isinstance(id_, str), id_
         uri = '/containers/{id}/stop'.format(id=id_)
         if params:
             uri += '?' + urlencode(params)
-        await _post_json(uri)
+        await self._post_json(uri)
+        self._invalidate(_CONTAINERS)
 
     async def pause(self, id_):
         assert isinstance(id_, str), id_
         uri = '/containers/{id}/pause'.format(id=id_)
-        await _post_json(uri)
+        await self._post_json(uri)
+        self._invalidate(_CONTAINERS)
 
     async def commit(self, *, params):
         uri = '/commit'
         if params:
             uri += '?' + urlencode(params)
-        return await _post_json(uri)
+        result = await self._post_json(uri)
+        self._invalidate(_IMAGES)
+        return result
+
+    async def tag(self, name, *, params):
+        uri = '/images/{name}/tag'.format(name=name)
+        if params:
+            uri += '?' + urlencode(params)
+        await self._post_json(uri)
+        self._invalidate(_IMAGES)
 
     async def unpause(self, id_):
         assert isinstance(id_, str), id_
         uri = '/containers/{id}/unpause'.format(id=id_)
-        await _post_json(uri)
+        await self._post_json(uri)
+        self._invalidate(_CONTAINERS)
 
     async def create_network(self, *, data):
         uri = '/networks/create'
-        return await _post_json(uri, data=data)
+        return await self._post_json(uri, data=data)
 
     async def put_archive(self, id_, arch, *, params):
         uri = '/containers/{id}/archive'.format(id=id_)
@@ -295,18 +431,9 @@ class Docker:
             ('Host', 'localhost'),
             ('transfer-encoding', 'chunked'),
         ]
-        async with connect_docker() as stream:
+        async with self._pool.connect() as stream:
             await stream.send_request('PUT', uri, headers, end_stream=False)
-            while True:
-                chunk = arch.read(CHUNK_SIZE)
-                if len(chunk) == CHUNK_SIZE:
-                    await stream.send_data(chunk, end_stream=False)
-                else:
-                    if chunk:
-                        await stream.send_data(chunk)
-                    else:
-                        await stream.end()
-                    break
+            await _send_file(stream, arch)
             response = await stream.recv_response()
             if response.status_code != 200:
                 raise response.error()
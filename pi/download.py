@@ -0,0 +1,432 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+import tarfile
+import tempfile
+import fcntl
+from typing import NamedTuple
+from asyncio import gather
+from pathlib import Path
+from weakref import WeakKeyDictionary
+from functools import lru_cache, partial
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urljoin
+
+from .http import open_tcp, ConnectionPool, HTTPError, ConnectionClosed
+from .utils import cache_dir
+
+
+log = logging.getLogger(__name__)
+
+SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 2**20
+MAX_RETRIES = 3
+
+HOST_CONNECTIONS = 6
+
+DECODE_CHUNK_SIZE = 2**16
+
+MAX_CACHE_SIZE = 2 * 2**30
+
+_RETRY_ERRORS = (OSError, ConnectionClosed, asyncio.TimeoutError)
+
+# loop -> (host, port, secure) -> pool
+_pools = WeakKeyDictionary()
+
+
+class _Target(NamedTuple):
+    host: str
+    port: int
+    secure: bool
+    netloc: str
+    path: str
+
+    @classmethod
+    def from_url(cls, url):
+        url_parts = urlsplit(url)
+        secure = True if url_parts.scheme == 'https' else False
+        host, _, port = url_parts.netloc.partition(':')
+        if not port:
+            port = 443 if url_parts.scheme == 'https' else 80
+        else:
+            port = int(port)
+        path = url_parts.path
+        if url_parts.query:
+            path += '?' + url_parts.query
+        return cls(host, port, secure, url_parts.netloc, path)
+
+
+def _connect(target):
+    """Connects using a keep-alive pool, shared by all downloads from the
+    same host, which also limits number of concurrent connections
+    """
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    key = (target.host, target.port, target.secure)
+    pool = pools.get(key)
+    if pool is None:
+        pool = pools[key] = ConnectionPool(
+            partial(open_tcp, target.host, target.port, secure=target.secure),
+            size=HOST_CONNECTIONS,
+            limit=HOST_CONNECTIONS,
+        )
+    return pool.connect()
+
+
+def close_pools():
+    pools = _pools.pop(asyncio.get_running_loop(), {})
+    for pool in pools.values():
+        pool.close()
+
+
+class _Segment:
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.offset = start
+
+    @property
+    def complete(self):
+        return self.offset >= self.end
+
+
+def _split(size):
+    count = max(1, min(SEGMENTS, size // MIN_SEGMENT_SIZE))
+    bounds = [size * i // count for i in range(count + 1)]
+    return [_Segment(start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+async def _read_segment(stream, fd, segment):
+    chunks = stream.recv_data_chunked()
+    try:
+        async for chunk in chunks:
+            chunk = chunk[:segment.end - segment.offset]
+            os.pwrite(fd, chunk, segment.offset)
+            segment.offset += len(chunk)
+            if segment.complete:
+                break
+    finally:
+        await chunks.aclose()
+
+
+async def _fetch_segment(target, fd, segment, validator):
+    headers = [('host', target.netloc), ('accept-encoding', 'identity')]
+    if validator is not None:
+        headers.append(('if-range', validator))
+    retries = 0
+    while not segment.complete:
+        range_ = 'bytes={}-{}'.format(segment.offset, segment.end - 1)
+        try:
+            async with _connect(target) as stream:
+                await stream.send_request('GET', target.path, [
+                    *headers, ('range', range_),
+                ])
+                response = await stream.recv_response()
+                if response.status_code != 206:
+                    raise HTTPError('Range request failed with status {}'
+                                    .format(response.status_code))
+                await _read_segment(stream, fd, segment)
+        except _RETRY_ERRORS:
+            if retries >= MAX_RETRIES:
+                raise
+            retries += 1
+            log.debug('Resuming download of %s from %d', target.path,
+                      segment.offset, exc_info=True)
+
+
+def _start_ranges(target, response, output):
+    size = int(response.headers[b'content-length'])
+    output.truncate(size)
+    fd = output.fileno()
+    validator = (response.headers.get(b'etag')
+                 or response.headers.get(b'last-modified'))
+    if validator is not None and validator.startswith(b'W/'):
+        validator = None  # weak validators are not allowed in If-Range
+
+    # first segment is received using already opened connection
+    first, *rest = _split(size)
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(_fetch_segment(target, fd, segment, validator))
+             for segment in rest]
+    return first, validator, tasks
+
+
+async def _read_first_segment(target, stream, output, first):
+    try:
+        await _read_segment(stream, output.fileno(), first)
+    except _RETRY_ERRORS:
+        log.debug('Download of %s interrupted at %d', target.path,
+                  first.offset, exc_info=True)
+
+
+def _decompress(decompressor, data):
+    # output is limited to keep memory usage constant
+    while data:
+        chunk = decompressor.decompress(data, DECODE_CHUNK_SIZE)
+        if chunk:
+            yield chunk
+        data = decompressor.unconsumed_tail
+
+
+async def _recv_encoded(url, stream, encoding, output):
+    if encoding not in {b'gzip', b'deflate'}:
+        raise HTTPError('Unsupported content encoding: {!r}'.format(encoding))
+    # automatic gzip or zlib header detection
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    received = decoded = 0
+    async for chunk in stream.recv_data_chunked():
+        received += len(chunk)
+        for data in _decompress(decompressor, chunk):
+            decoded += len(data)
+            output.write(data)
+    data = decompressor.flush()
+    if data:
+        decoded += len(data)
+        output.write(data)
+    if not decompressor.eof:
+        raise HTTPError('Incomplete {} stream'.format(encoding.decode()))
+    log.debug('Downloaded %s: %d bytes received, %d bytes decoded, '
+              '%d bytes saved', url, received, decoded, decoded - received)
+
+
+def _ranges_supported(response):
+    headers = response.headers
+    return (
+        headers.get(b'accept-ranges') == b'bytes'
+        and b'content-length' in headers
+        and b'content-encoding' not in headers
+    )
+
+
+async def fetch(url, output, *, headers=(), _max_redirects=5):
+    """Downloads file into the `output`, which should be a real file
+
+    When server supports range requests, large files are downloaded in
+    several segments in parallel and interrupted transfers are resumed.
+    """
+    redirects = 0
+    initial_url = url
+    initial_secure = None
+    while redirects < _max_redirects:
+        target = _Target.from_url(url)
+
+        if redirects == 0:
+            initial_secure = target.secure
+        if initial_secure is True and target.secure is False:
+            raise Exception(f'Redirect to insecure url: {url}')
+
+        tasks = []
+        try:
+            async with _connect(target) as stream:
+                await stream.send_request('GET', target.path, [
+                    ('host', target.netloc),
+                    ('accept-encoding', 'gzip, deflate'),
+                    *headers,
+                ])
+                response = await stream.recv_response()
+                if response.status_code in {301, 302}:
+                    # body is consumed to return connection into the pool
+                    async for _ in stream.recv_data_chunked():
+                        pass
+                    location = response.headers[b'location'].decode('ascii')
+                    url = urljoin(url, location)
+                    redirects += 1
+                    continue
+                elif response.status_code == 304:
+                    return response
+                elif response.status_code != 200:
+                    response.error()
+                encoding = response.headers.get(b'content-encoding',
+                                                b'identity')
+                if encoding != b'identity':
+                    await _recv_encoded(url, stream, encoding, output)
+                    return response
+                elif not _ranges_supported(response):
+                    async for chunk in stream.recv_data_chunked():
+                        output.write(chunk)
+                    log.debug('Downloaded %s: %r', url, stream.stats)
+                    return response
+                first, validator, tasks = _start_ranges(target, response,
+                                                        output)
+                await _read_first_segment(target, stream, output, first)
+            # connection is released before waiting for other segments,
+            # because they are limited by the same per-host pool
+            await _fetch_segment(target, output.fileno(), first, validator)
+            await gather(*tasks)
+            log.debug('Downloaded %s in %d segment(s)', url, len(tasks) + 1)
+            return response
+        finally:
+            for task in tasks:
+                task.cancel()
+    else:
+        raise Exception(f'More than {_max_redirects} redirects: {initial_url}')
+
+
+def _file_digest(file):
+    h = hashlib.sha256()
+    file.seek(0)
+    while True:
+        chunk = file.read(2**16)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h.hexdigest()
+
+
+class DownloadCache:
+    """Content-addressed cache of downloaded files
+
+    Every file is stored as a tar archive with a single member, named after
+    sha256 digest of the file, so archive can be sent to the Docker as is.
+    Cached files are revalidated using ETag and Last-Modified headers and
+    least recently used files are evicted when cache exceeds `max_size`.
+
+    Index is shared by concurrent processes, so it is re-read and updated
+    under a file lock. Files, returned by this cache, are never evicted by
+    it, because they can still be in use.
+    """
+
+    def __init__(self, path, *, max_size=MAX_CACHE_SIZE):
+        self._path = Path(path)
+        self._blobs_path = self._path / 'blobs'
+        self._blobs_path.mkdir(parents=True, exist_ok=True)
+        self._index_path = self._path / 'index.json'
+        self._lock_path = self._path / 'index.lock'
+        self._max_size = max_size
+        self._locks = defaultdict(asyncio.Lock)
+        self._pinned = set()
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'urls': {}, 'blobs': {}}
+
+    def _write_index(self, index):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                                         dir=self._path, delete=False) as f:
+            json.dump(index, f)
+        os.replace(f.name, self._index_path)
+
+    @contextmanager
+    def _update_index(self):
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def blob_path(self, digest):
+        return self._blobs_path / '{}.tar'.format(digest)
+
+    def _store(self, file, digest):
+        blob_path = self.blob_path(digest)
+        if blob_path.exists():
+            return
+        with tempfile.NamedTemporaryFile(dir=self._blobs_path,
+                                         delete=False) as tmp:
+            with tarfile.open(fileobj=tmp, mode='w:tar') as tar:
+                file.seek(0)
+                tar.addfile(tar.gettarinfo(arcname=digest, fileobj=file),
+                            fileobj=file)
+        os.replace(tmp.name, blob_path)
+
+    def _evict(self, index):
+        blobs = index['blobs']
+        total = sum(blob['size'] for blob in blobs.values())
+        lru = sorted(blobs.items(), key=lambda i: i[1]['used'])
+        evicted = set()
+        for digest, blob in lru:
+            if total <= self._max_size:
+                break
+            if digest in self._pinned:
+                continue
+            try:
+                self.blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+            total -= blob['size']
+            evicted.add(digest)
+        for digest in evicted:
+            del blobs[digest]
+        index['urls'] = {url: entry for url, entry in index['urls'].items()
+                         if entry['digest'] not in evicted}
+
+    def _cached(self, url):
+        index = self._read_index()
+        entry = index['urls'].get(url)
+        if (
+            entry is None
+            or entry['digest'] not in index['blobs']
+            or not self.blob_path(entry['digest']).exists()
+        ):
+            return None
+        return entry
+
+    async def fetch(self, url):
+        """Returns digest of the file and path to the archive with it"""
+        async with self._locks[url]:
+            entry = self._cached(url)
+            while True:
+                headers = []
+                if entry is not None:
+                    if entry['etag'] is not None:
+                        headers.append(('if-none-match', entry['etag']))
+                    if entry['last_modified'] is not None:
+                        headers.append(('if-modified-since',
+                                        entry['last_modified']))
+
+                with tempfile.NamedTemporaryFile(dir=self._path) as tmp:
+                    response = await fetch(url, tmp, headers=headers)
+                    not_modified = (response.status_code == 304
+                                    and entry is not None)
+                    if not_modified:
+                        log.debug('Not modified: %s', url)
+                        digest = entry['digest']
+                    else:
+                        tmp.flush()
+                        loop = asyncio.get_running_loop()
+                        digest = await loop.run_in_executor(
+                            None, _file_digest, tmp,
+                        )
+                        self._store(tmp, digest)
+
+                # pinned before eviction, made by this or other fetches
+                self._pinned.add(digest)
+                with self._update_index() as index:
+                    if not not_modified:
+                        index['urls'][url] = {
+                            'digest': digest,
+                            'etag': _header(response, b'etag'),
+                            'last_modified': _header(response,
+                                                     b'last-modified'),
+                        }
+                        index['blobs'][digest] = {
+                            'size': self.blob_path(digest).stat().st_size,
+                        }
+                    blob = index['blobs'].get(digest)
+                    if blob is not None and self.blob_path(digest).exists():
+                        blob['used'] = time.time()
+                        self._evict(index)
+                        return digest, self.blob_path(digest)
+                # evicted by another process after revalidation
+                entry = None
+
+
+def _header(response, name):
+    value = response.headers.get(name)
+    return value.decode('latin-1') if value is not None else None
+
+
+@lru_cache(maxsize=None)
+def download_cache():
+    return DownloadCache(cache_dir('downloads'))
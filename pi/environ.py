@@ -1,19 +1,26 @@
 from .utils import cached_property, SequenceMap
 from .docker import Docker
+from .images import ImageVersions
+from .registry import Registry, missing_cache
 
 
 class Environ:
     docker: Docker
 
-    def __init__(self, meta, images, services):
+    def __init__(self, meta, images, services, commands=()):
         self._meta = meta
         self.images = SequenceMap(images, lambda i: i.name)
         self.services = SequenceMap(services, lambda i: i.name)
+        self.commands = list(commands)
 
     @property
     def namespace(self):
         return self._meta.namespace or 'default'
 
+    @property
+    def build_backend(self):
+        return self._meta.build_backend
+
     @property
     def network(self):
         return 'pi-{}'.format(self.namespace)
@@ -21,3 +28,15 @@ class Environ:
     @cached_property
     def docker(self):
         return Docker()
+
+    @cached_property
+    def versions(self):
+        return ImageVersions(self.images)
+
+    @cached_property
+    def registry(self):
+        return Registry(missing=missing_cache())
+
+    def close(self):
+        if 'docker' in self.__dict__:
+            self.docker.close()
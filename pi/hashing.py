@@ -0,0 +1,227 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import tempfile
+import threading
+
+from stat import S_ISREG
+from pathlib import Path
+from functools import lru_cache
+
+from .utils import cache_dir, process_pool
+
+
+# files modified within this interval may be modified again without
+# changing their mtime, so their digests are not cached
+RACY_INTERVAL = 2
+
+# minimal number of changed files to hash them using a process pool
+PARALLEL_THRESHOLD = 64
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+    return h.hexdigest()
+
+
+def _stat_key(stat):
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def _is_racy(mtime_ns, now):
+    return now - mtime_ns / 1e9 <= RACY_INTERVAL
+
+
+class _Tree:
+    """Directory snapshot, made using only stat calls
+
+    Signature changes when any file in a subtree is changed according to
+    its stat, so digest of the unchanged subtree can be reused.
+    """
+
+    def __init__(self, path, entries, signature, racy):
+        self.path = path
+        self.entries = entries
+        self.signature = signature
+        self.racy = racy
+
+
+def _entry_line(kind, name, value):
+    return f'{kind} {name}\0{value}\n'
+
+
+def _digest_lines(h, lines):
+    h.update(''.join(lines).encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def _scan(path, now):
+    entries = []
+    lines = []
+    racy = False
+    with os.scandir(path) as it:
+        dir_entries = sorted(it, key=lambda e: e.name)
+    for entry in dir_entries:
+        name = entry.name
+        if entry.is_dir(follow_symlinks=False):
+            value = _scan(entry.path, now)
+            lines.append(_entry_line('d', name, value.signature))
+            entries.append(('d', name, value))
+            racy = racy or value.racy
+        elif entry.is_symlink():
+            # symlinks are not followed, they may be dangling or point
+            # outside of the directory
+            value = os.readlink(entry.path)
+            lines.append(_entry_line('l', name, value))
+            entries.append(('l', name, value))
+        else:
+            stat = entry.stat(follow_symlinks=False)
+            if not S_ISREG(stat.st_mode):
+                # bundles do not include sockets, pipes and devices
+                continue
+            kind = 'x' if stat.st_mode & 0o111 else 'f'
+            mtime_ns = stat.st_mtime_ns
+            lines.append(f'{kind} {name}\0{stat.st_ino}:{stat.st_size}:'
+                         f'{mtime_ns}\n')
+            entries.append((kind, name, _stat_key(stat)))
+            racy = racy or _is_racy(mtime_ns, now)
+    signature = _digest_lines(hashlib.sha1(), lines)
+    return _Tree(path, entries, signature, racy)
+
+
+def _map_digests(paths):
+    if len(paths) < PARALLEL_THRESHOLD:
+        return list(map(file_digest, paths))
+    return list(process_pool().map(file_digest, paths, chunksize=16))
+
+
+class DigestCache:
+    """Persistent cache of file and directory digests
+
+    File digests are keyed by file path, inode, size and modification time,
+    so unchanged files are not read again. Directory digests are computed
+    as a Merkle tree and are keyed by signature of the subtree.
+
+    Digests can be computed concurrently in several threads.
+    """
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._indexes = {}
+        self._changed = set()
+        self._lock = threading.RLock()
+
+    def _read_index(self, name):
+        try:
+            with open(self._path / name, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _index(self, name):
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is None:
+                index = self._indexes[name] = self._read_index(name)
+            return index
+
+    @property
+    def _files(self):
+        return self._index('files.json')
+
+    @property
+    def _trees(self):
+        # stored separately, so file digests are not even loaded when
+        # directories are not changed
+        return self._index('trees.json')
+
+    def _cached_file(self, path, key):
+        entry = self._files.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+        return None
+
+    def _cache_file(self, path, key, digest, now):
+        if not _is_racy(key[2], now):
+            with self._lock:
+                self._files[path] = key + [digest]
+                self._changed.add('files.json')
+
+    def file_digest(self, path):
+        path = os.path.abspath(path)
+        key = _stat_key(os.stat(path))
+        digest = self._cached_file(path, key)
+        if digest is None:
+            digest = file_digest(path)
+            self._cache_file(path, key, digest, time.time())
+        return digest
+
+    def _cached_tree(self, tree):
+        entry = self._trees.get(tree.path)
+        if entry is not None and entry[0] == tree.signature:
+            return entry[1]
+        return None
+
+    def _changed_files(self, tree):
+        if self._cached_tree(tree) is not None:
+            return
+        for kind, name, value in tree.entries:
+            path = os.path.join(tree.path, name)
+            if kind == 'd':
+                yield from self._changed_files(value)
+            elif kind in {'f', 'x'} and self._cached_file(path, value) is None:
+                yield path, value
+
+    def _tree_digest(self, tree, digests):
+        digest = self._cached_tree(tree)
+        if digest is not None:
+            return digest
+        lines = []
+        for kind, name, value in tree.entries:
+            path = os.path.join(tree.path, name)
+            if kind == 'd':
+                entry_digest = self._tree_digest(value, digests)
+            elif kind == 'l':
+                entry_digest = value
+            else:
+                entry_digest = (digests.get(path)
+                                or self._cached_file(path, value))
+            lines.append(_entry_line(kind, name, entry_digest))
+        digest = _digest_lines(hashlib.sha256(), lines)
+        if not tree.racy:
+            with self._lock:
+                self._trees[tree.path] = [tree.signature, digest]
+                self._changed.add('trees.json')
+        return digest
+
+    def tree_digest(self, path):
+        """Returns digest of the directory, reading only changed files"""
+        now = time.time()
+        tree = _scan(os.path.abspath(path), now)
+        changed = list(self._changed_files(tree))
+        paths = [path for path, _ in changed]
+        digests = dict(zip(paths, _map_digests(paths)))
+        for path, key in changed:
+            self._cache_file(path, key, digests[path], now)
+        return self._tree_digest(tree, digests)
+
+    def save(self):
+        with self._lock:
+            for name in self._changed:
+                with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                                                 dir=self._path,
+                                                 delete=False) as f:
+                    json.dump(self._indexes[name], f)
+                os.replace(f.name, self._path / name)
+            self._changed.clear()
+
+
+@lru_cache(maxsize=None)
+def digest_cache():
+    return DigestCache(cache_dir('hashes'))
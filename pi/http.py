@@ -1,7 +1,13 @@
+import re
 import ssl
+import json
+import codecs
 import socket
 import asyncio
 from asyncio import Event
+from functools import lru_cache
+from contextvars import ContextVar
+from collections import deque, OrderedDict
 
 from typing import cast, NamedTuple
 from contextlib import asynccontextmanager
@@ -25,6 +31,40 @@ else:
         pass
 
 
+TLS_SESSIONS_SIZE = 256
+
+_tls_peer = ContextVar('tls_peer', default=None)
+_tls_sessions = OrderedDict()
+
+
+class _SSLContext(ssl.SSLContext):
+    """Resumes TLS sessions, previously established with the same peer"""
+
+    def wrap_bio(self, *args, **kwargs):
+        peer = _tls_peer.get()
+        if peer is not None and kwargs.get('session') is None:
+            kwargs['session'] = _tls_sessions.get(peer)
+        return super().wrap_bio(*args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def ssl_context():
+    """Shared client context, so CA certificates are loaded only once"""
+    context = _SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs()
+    return context
+
+
+def _save_tls_session(peer, ssl_object):
+    session = ssl_object.session
+    if session is None or _tls_sessions.get(peer) is session:
+        return
+    _tls_sessions[peer] = session
+    _tls_sessions.move_to_end(peer)
+    while len(_tls_sessions) > TLS_SESSIONS_SIZE:
+        _tls_sessions.popitem(last=False)
+
+
 class HTTPError(Exception):
 
     def __init__(self, reason):
@@ -32,6 +72,104 @@ class HTTPError(Exception):
         self.reason = reason
 
 
+class ConnectionClosed(Exception):
+    pass
+
+
+BUFFER_SIZE = 2**16
+
+HIGH_WATER = 2**20
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DELIMITER = re.compile(r'[ \t\n\r,\]]')
+
+
+class JSONArrayDecoder:
+    """Incrementally decodes top-level JSON array and returns its elements
+    as soon as they were completely received
+    """
+    _START, _FIRST, _NEXT, _AFTER, _END = range(5)
+
+    def __init__(self):
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._state = self._START
+
+    def feed(self, data, *, final=False):
+        buf = self._buffer + self._text_decoder.decode(data, final)
+        items = []
+        pos = _WHITESPACE.match(buf).end()
+        while pos < len(buf):
+            char = buf[pos]
+            if self._state == self._START:
+                if char != '[':
+                    raise ValueError('JSON array expected')
+                self._state = self._FIRST
+                pos += 1
+            elif self._state == self._AFTER or (
+                self._state == self._FIRST and char == ']'
+            ):
+                if char == ']':
+                    self._state = self._END
+                elif char == ',':
+                    self._state = self._NEXT
+                else:
+                    raise ValueError('Unexpected character: {!r}'
+                                     .format(char))
+                pos += 1
+            elif self._state == self._END:
+                raise ValueError('Extra data after JSON array')
+            else:
+                try:
+                    item, end = self._decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                # numbers and literals are complete only when followed by a
+                # delimiter, e.g. "1." at the end of the buffer is decoded
+                # as 1, so wait for the next chunk to be sure
+                incomplete = (not final
+                              and not isinstance(item, (dict, list, str))
+                              and not _DELIMITER.search(buf, end))
+                if incomplete:
+                    break
+                items.append(item)
+                self._state = self._AFTER
+                pos = end
+            pos = _WHITESPACE.match(buf, pos).end()
+        self._buffer = buf[pos:]
+        return items
+
+    def close(self):
+        items = self.feed(b'', final=True)
+        if self._state != self._END:
+            raise ValueError('Incomplete JSON array')
+        return items
+
+
+class NDJSONDecoder:
+    """Incrementally decodes newline-delimited JSON documents
+
+    Data is split into lines as bytes, so documents and multi-byte
+    characters can span several chunks and every line is decoded once.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+
+    def feed(self, data):
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        return [json.loads(line) for line in lines
+                if line and not line.isspace()]
+
+    def close(self):
+        data, self._buffer = self._buffer, b''
+        return self.feed(data + b'\n')
+
+
 class Response(NamedTuple):
     status_code: int
     headers: dict
@@ -45,6 +183,13 @@ class Response(NamedTuple):
         raise HTTPError(reason)
 
 
+class StreamStats(NamedTuple):
+    received: int
+    buffered: int
+    max_buffered: int
+    pauses: int
+
+
 class Stream:
 
     def __init__(self, protocol, connection: h11.Connection,
@@ -55,13 +200,58 @@ class Stream:
 
         self._response = None
         self._response_waiter = asyncio.Event()
-        self._data = []
+        self._data = deque()
         self._data_size = 0
         self._data_waiter = asyncio.Event()
         self._eof = False
 
+        self._buffered = 0
+        self._max_buffered = 0
+        self._pauses = 0
+        self._paused = False
+        self._flow_control = True
+        self.set_buffer_limits()
+
         self._wrapper = Wrapper()
 
+    def set_buffer_limits(self, high=None, low=None):
+        """Reading from the transport is paused when more than `high` bytes
+        are buffered and not yet consumed, and resumed when buffer size
+        drops to `low` bytes
+        """
+        if high is None:
+            high = HIGH_WATER if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError('high ({!r}) must be >= low ({!r}) must be >= 0'
+                             .format(high, low))
+        self._high_water = high
+        self._low_water = low
+
+    @property
+    def stats(self):
+        return StreamStats(self._data_size, self._buffered,
+                           self._max_buffered, self._pauses)
+
+    def _maybe_pause(self):
+        if (
+            self._flow_control
+            and not self._paused
+            and self._buffered > self._high_water
+        ):
+            self._paused = True
+            self._pauses += 1
+            self.transport.pause_reading()
+
+    def _maybe_resume(self):
+        if self._paused and (
+            not self._flow_control
+            or self._buffered <= self._low_water
+        ):
+            self._paused = False
+            self.transport.resume_reading()
+
     async def send_request(self, method, path, headers, *, end_stream=True):
         data = self.connection.send(h11.Request(method=method, target=path,
                                                 headers=headers))
@@ -83,6 +273,9 @@ class Stream:
                             self._response.reason)
 
     async def recv_data(self, content_length):
+        # whole body is buffered anyway
+        self._flow_control = False
+        self._maybe_resume()
         with self._wrapper:
             while True:
                 await self._data_waiter.wait()
@@ -97,14 +290,24 @@ class Stream:
         with self._wrapper:
             while True:
                 await self._data_waiter.wait()
-                for chunk in self._data:
+                while self._data:
+                    chunk = self._data.popleft()
+                    self._buffered -= len(chunk)
+                    self._maybe_resume()
                     yield chunk
-                del self._data[:]
                 if self._eof:
                     break
                 else:
                     self._data_waiter.clear()
 
+    async def recv_json_array(self):
+        decoder = JSONArrayDecoder()
+        async for chunk in self.recv_data_chunked():
+            for item in decoder.feed(chunk):
+                yield item
+        for item in decoder.close():
+            yield item
+
     async def end(self):
         data = self.connection.send(h11.EndOfMessage())
         self.transport.write(data)
@@ -116,28 +319,43 @@ class Stream:
     def __data__(self, data: h11.Data):
         self._data.append(data.data)
         self._data_size += len(data.data)
+        self._buffered += len(data.data)
+        self._max_buffered = max(self._max_buffered, self._buffered)
         self._data_waiter.set()
+        self._maybe_pause()
 
     def __end__(self):
         self._eof = True
         self._data_waiter.set()
+        # no more data expected, connection should be ready for reuse
+        self._flow_control = False
+        self._maybe_resume()
 
     def __terminated__(self):
         if not self._eof:
-            self._wrapper.cancel(Exception('Connection closed'))
+            self._wrapper.cancel(ConnectionClosed('Connection closed'))
+
 
+class HTTPProtocol(asyncio.BufferedProtocol):
+    """Receives data into a preallocated buffer, which is reused for every
+    read, so no intermediate bytes objects are created for received data.
 
-class HTTPProtocol(asyncio.Protocol):
+    Memoryview slices of this buffer are valid only during the call, so
+    consumers should copy data if they want to keep it (h11 and pipe
+    transports are doing this already).
+    """
     connection = None
     transport: asyncio.Transport = None
     stream: Stream = None
 
     hijacked = False
 
-    def __init__(self, *, stdin_proto=None, stdout_proto=None):
+    def __init__(self, *, stdin_proto=None, stdout_proto=None, tls_peer=None):
         self._stdin_proto = stdin_proto
         self._stdout_proto = stdout_proto
+        self._tls_peer = tls_peer
         self._closed = Event()
+        self._buffer = memoryview(bytearray(BUFFER_SIZE))
 
     def connection_made(self, transport):
         sock = transport.get_extra_info('socket')
@@ -158,7 +376,11 @@ class HTTPProtocol(asyncio.Protocol):
             assert self._stdin_proto
             self._stdin_proto.transport.resume_reading()
 
-    def data_received(self, data: bytes):
+    def get_buffer(self, sizehint):
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        data = self._buffer[:nbytes]
         if self.hijacked:
             assert self._stdout_proto
             self._stdout_proto.transport.write(data)
@@ -175,10 +397,17 @@ class HTTPProtocol(asyncio.Protocol):
                     self.stream.__response__(event)
                     if event.status_code == 101:
                         self.hijacked = True
+                        # data, received right after the response
+                        trailing_data, _ = self.connection.trailing_data
+                        if trailing_data and self._stdout_proto:
+                            self._stdout_proto.transport.write(trailing_data)
+                        break
                 elif event_type is h11.Data:
                     self.stream.__data__(event)
                 elif event_type is h11.EndOfMessage:
                     self.stream.__end__()
+                    # TLS 1.3 session tickets are received after handshake
+                    self.save_tls_session()
                 elif event is h11.NEED_DATA:
                     break
                 elif event is h11.PAUSED:
@@ -193,33 +422,129 @@ class HTTPProtocol(asyncio.Protocol):
     async def wait_closed(self):
         return await self._closed.wait()
 
+    def save_tls_session(self):
+        if self._tls_peer is not None:
+            ssl_object = self.transport.get_extra_info('ssl_object')
+            if ssl_object is not None:
+                _save_tls_session(self._tls_peer, ssl_object)
+
+    @property
+    def reusable(self):
+        return (
+            not self.hijacked
+            and not self.transport.is_closing()
+            and self.connection.our_state is h11.DONE
+            and self.connection.their_state is h11.DONE
+        )
+
+    def reset(self):
+        self.connection.start_next_cycle()
+        self.stream = Stream(self, self.connection, self.transport)
 
-@asynccontextmanager
-async def connect_unix(path, *, stdin_proto=None, stdout_proto=None):
+
+async def open_unix(path, *, stdin_proto=None, stdout_proto=None):
     loop = asyncio.get_running_loop()
-    transport, protocol = await loop.create_unix_connection(
+    _, protocol = await loop.create_unix_connection(
         lambda: HTTPProtocol(stdin_proto=stdin_proto,
                              stdout_proto=stdout_proto),
         path,
     )
+    return cast(HTTPProtocol, protocol)
+
+
+async def open_tcp(
+    host, port, *, secure=False, stdin_proto=None, stdout_proto=None,
+):
+    loop = asyncio.get_running_loop()
+    tls_peer = (host, port) if secure else None
+    token = _tls_peer.set(tls_peer)
+    try:
+        _, protocol = await loop.create_connection(
+            lambda: HTTPProtocol(stdin_proto=stdin_proto,
+                                 stdout_proto=stdout_proto,
+                                 tls_peer=tls_peer),
+            host, port, ssl=ssl_context() if secure else None,
+        )
+    finally:
+        _tls_peer.reset(token)
+    protocol = cast(HTTPProtocol, protocol)
+    protocol.save_tls_session()
+    return protocol
+
+
+@asynccontextmanager
+async def connect_unix(path, *, stdin_proto=None, stdout_proto=None):
+    protocol = await open_unix(path, stdin_proto=stdin_proto,
+                               stdout_proto=stdout_proto)
     try:
-        yield cast(HTTPProtocol, protocol).stream
+        yield protocol.stream
     finally:
-        transport.close()
+        protocol.transport.close()
 
 
 @asynccontextmanager
 async def connect_tcp(
     host, port, *, secure=False, stdin_proto=None, stdout_proto=None,
 ):
-    loop = asyncio.get_running_loop()
-    ssl_context = ssl.create_default_context() if secure else None
-    transport, protocol = await loop.create_connection(
-        lambda: HTTPProtocol(stdin_proto=stdin_proto,
-                             stdout_proto=stdout_proto),
-        host, port, ssl=ssl_context,
-    )
+    protocol = await open_tcp(host, port, secure=secure,
+                              stdin_proto=stdin_proto,
+                              stdout_proto=stdout_proto)
     try:
-        yield cast(HTTPProtocol, protocol).stream
+        yield protocol.stream
     finally:
-        transport.close()
+        protocol.transport.close()
+
+
+class ConnectionPool:
+    """Keeps idle HTTP/1.1 connections open to reuse them for the next
+    requests.
+
+    Connection is returned into the pool only when request and response
+    were completely sent and received, otherwise it is closed.
+    """
+
+    def __init__(self, connect, *, size=10, idle_timeout=30, limit=None):
+        self._connect = connect
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._idle = deque()
+        self._limit = asyncio.Semaphore(limit) if limit else None
+
+    async def acquire(self) -> HTTPProtocol:
+        now = asyncio.get_running_loop().time()
+        while self._idle:
+            protocol, expires_at = self._idle.pop()
+            if expires_at > now and not protocol.transport.is_closing():
+                return protocol
+            protocol.transport.close()
+        return await self._connect()
+
+    def release(self, protocol: HTTPProtocol):
+        if protocol.reusable and len(self._idle) < self._size:
+            protocol.reset()
+            expires_at = asyncio.get_running_loop().time() + self._idle_timeout
+            self._idle.append((protocol, expires_at))
+        else:
+            protocol.transport.close()
+
+    @asynccontextmanager
+    async def connect(self):
+        """Yields stream of the idle or new connection, waits when `limit`
+        of the concurrently used connections is reached
+        """
+        if self._limit is not None:
+            await self._limit.acquire()
+        try:
+            protocol = await self.acquire()
+            try:
+                yield protocol.stream
+            finally:
+                self.release(protocol)
+        finally:
+            if self._limit is not None:
+                self._limit.release()
+
+    def close(self):
+        while self._idle:
+            protocol, _ = self._idle.pop()
+            protocol.transport.close()
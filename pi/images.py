@@ -1,12 +1,19 @@
-import json
+import math
+import time
+import asyncio
 import hashlib
 
-from .http import HTTPError
+from .http import HTTPError, NDJSONDecoder
+from .utils import format_size
+from .hashing import digest_cache
 from .types import DockerImage, Image, ActionType
 
 
 class Hasher:
 
+    def __init__(self, digests=None):
+        self._digests = digests or digest_cache()
+
     def visit(self, obj):
         return obj.accept(self)
 
@@ -27,58 +34,100 @@ class Hasher:
         yield obj.url.encode('utf-8')
 
     def visit_file(self, obj):
-        with open(obj.path, 'rb') as f:
-            while True:
-                chunk = f.read(2**16)
-                if not chunk:
-                    break
-                else:
-                    yield chunk
+        yield self._digests.file_digest(obj.path).encode('ascii')
 
     def visit_bundle(self, obj):
         yield obj.path.encode('utf-8')
+        yield self._digests.tree_digest(obj.path).encode('ascii')
 
 
-def image_hashes(images_map, images, *, _cache=None):
-    _cache = _cache or {}
+def layers_repository(repository):
+    """Repository for intermediate images with results of image tasks"""
+    return '{}-layers'.format(repository)
 
-    hasher = Hasher()
-    hashes = []
-    for image in images:
-        if image.name in _cache:
-            hashes.append(_cache[image.name])
-            continue
+
+class ImageVersions:
+    """Index of image versions, which are computed lazily and only once
+
+    Parent images are hashed before their children, so every image in the
+    hierarchy is hashed at most once.
+    """
+
+    def __init__(self, images_map, *, digests=None):
+        self.images_map = images_map
+        self._digests = digests or digest_cache()
+        self._hasher = Hasher(self._digests)
+        self._hashes = {}
+        self._pending = {}
+
+    def hash(self, image):
+        hex_digest = self._hashes.get(image.name)
+        if hex_digest is not None:
+            return hex_digest
 
         if isinstance(image.from_, DockerImage):
             parent_hashable = image.from_.name
         else:
-            parent = images_map.get(image.from_)
-            parent_hashable, = image_hashes(images_map, [parent],
-                                            _cache=_cache)
+            parent_hashable = self.hash(self.images_map.get(image.from_))
 
         h = hashlib.sha1()
         h.update(parent_hashable.encode('utf-8'))
-        for chunk in hasher.visit(image):
+        for chunk in self._hasher.visit(image):
             h.update(chunk)
-        hex_digest = _cache[image.name] = h.hexdigest()
-        hashes.append(hex_digest)
-    return hashes
-
-
-def image_versions(images_map, images):
-    hashes = image_hashes(images_map, images)
-    return [h[:12] for h in hashes]
-
-
-def docker_image(images_map, image):
-    if isinstance(image, str):
-        image = images_map.get(image)
-        version, = image_versions(images_map, [image])
-        return DockerImage.from_image(image, version)
-    elif isinstance(image, DockerImage):
-        return image
-    else:
-        raise TypeError(repr(image))
+        hex_digest = self._hashes[image.name] = h.hexdigest()
+        self._digests.save()
+        return hex_digest
+
+    async def _hash_async(self, image):
+        if not isinstance(image.from_, DockerImage):
+            await self._prepare(self.images_map.get(image.from_))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.hash, image)
+
+    def _prepare(self, image):
+        future = self._pending.get(image.name)
+        if future is None:
+            future = self._pending[image.name] = asyncio.ensure_future(
+                self._hash_async(image),
+            )
+        return future
+
+    async def prepare(self, images):
+        """Hashes images in threads, independent images are hashed
+        concurrently, so event loop is not blocked by file I/O
+        """
+        await asyncio.gather(*(self._prepare(image) for image in images
+                               if image.name not in self._hashes))
+
+    def version(self, image):
+        return self.hash(image)[:12]
+
+    def layers(self, image):
+        """Returns intermediate images for every task of the image, each
+        layer depends on the parent image and on all the previous tasks
+        """
+        repository = layers_repository(image.repository)
+        h = hashlib.sha1()
+        h.update(self.docker_image(image.from_).name.encode('utf-8'))
+        layers = []
+        for task in image.tasks:
+            task_hash = hashlib.sha1()
+            for chunk in self._hasher.visit(task):
+                task_hash.update(chunk)
+            h.update(task_hash.digest())
+            layers.append(DockerImage('{}:{}'.format(repository,
+                                                     h.hexdigest())))
+        self._digests.save()
+        return layers
+
+    def docker_image(self, image):
+        if isinstance(image, str):
+            image = self.images_map.get(image)
+            return DockerImage.from_image(image, self.version(image))
+        elif isinstance(image, DockerImage):
+            return image
+        else:
+            raise TypeError(repr(image))
 
 
 def resolve_deps(deps):
@@ -100,47 +149,90 @@ def get_images(config):
     return [i for i in config if isinstance(i, Image)]
 
 
-def _process_pull_progress(status, image):
-    key = status.add_task('=> Pulling image {}'.format(image))
+class _Progress:
+    """Aggregates transferred bytes of all layers into overall progress"""
+
+    def __init__(self, transfer, complete):
+        self._transfer = transfer
+        self._complete = complete
+        self._layers = {}
+        self._started_at = time.monotonic()
+
+    def update(self, event):
+        status = event['status']
+        if status == self._transfer:
+            detail = event.get('progressDetail') or {}
+            if detail.get('total'):
+                self._layers[event['id']] = [detail['current'],
+                                             detail['total']]
+        elif status in self._complete and event['id'] in self._layers:
+            layer = self._layers[event['id']]
+            layer[0] = layer[1]
+
+    def format(self):
+        current = sum(layer[0] for layer in self._layers.values())
+        total = sum(layer[1] for layer in self._layers.values())
+        if not current:
+            return None
+        rate = current / max(time.monotonic() - self._started_at, 1e-3)
+        eta = math.ceil((total - current) / rate)
+        return '{} / {}, {}/s, ETA {}s'.format(
+            format_size(current), format_size(total), format_size(rate), eta,
+        )
+
+
+def _process_progress(status, title, progress):
+    key = status.add_task(title)
     steps = {}
     while True:
         event = yield
         if event.get('status', '').startswith('Pulling from '):
             continue
         if 'id' in event:
-            title = '  [{}] '.format(event['id']) + event['status']
+            step_title = '  [{}] '.format(event['id']) + event['status']
             if 'progress' in event:
-                title += ': ' + event['progress']
+                step_title += ': ' + event['progress']
             if event['id'] in steps:
-                status.update(steps[event['id']], title)
+                status.update(steps[event['id']], step_title)
             else:
-                steps[event['id']] = status.add_step(key, title)
+                steps[event['id']] = status.add_step(key, step_title)
+            progress.update(event)
+            summary = progress.format()
+            if summary is not None:
+                status.update(key, '{} ({})'.format(title, summary))
+
+
+def _process_pull_progress(status, image):
+    return _process_progress(
+        status, '=> Pulling image {}'.format(image),
+        _Progress('Downloading', {'Download complete', 'Pull complete'}),
+    )
 
 
 def _process_push_progress(status, image):
-    key = status.add_task('=> Pushing image {}'.format(image))
-    steps = {}
-    while True:
-        event = yield
-        if 'id' in event:
-            title = '  [{}] '.format(event['id']) + event['status']
-            if 'progress' in event:
-                title += ': ' + event['progress']
-            if event['id'] in steps:
-                status.update(steps[event['id']], title)
-            else:
-                steps[event['id']] = status.add_step(key, title)
+    return _process_progress(
+        status, '=> Pushing image {}'.format(image),
+        _Progress('Pushing', {'Pushed'}),
+    )
+
+
+async def _process_stream(chunks, gen):
+    gen.send(None)
+    decoder = NDJSONDecoder()
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            gen.send(event)
+    for event in decoder.close():
+        gen.send(event)
 
 
 async def pull(docker, docker_image_: DockerImage, *, status):
     repository, _, tag = docker_image_.name.partition(':')
     params = {'fromImage': repository, 'tag': tag}
     try:
-        gen = _process_pull_progress(status, docker_image_.name)
-        gen.send(None)
-        async for chunk in docker.create_image(params=params):
-            for doc in chunk.decode('utf-8').splitlines():
-                gen.send(json.loads(doc))
+        await _process_stream(docker.create_image(params=params),
+                              _process_pull_progress(status,
+                                                     docker_image_.name))
     except HTTPError:
         return False
     else:
@@ -151,11 +243,9 @@ async def push(docker, docker_image_, *, status):
     name, _, tag = docker_image_.name.partition(':')
     params = {'tag': tag}
     try:
-        gen = _process_push_progress(status, docker_image_.name)
-        gen.send(None)
-        async for chunk in docker.push(name, params=params):
-            for doc in chunk.decode('utf-8').splitlines():
-                gen.send(json.loads(doc))
+        await _process_stream(docker.push(name, params=params),
+                              _process_push_progress(status,
+                                                     docker_image_.name))
     except HTTPError:
         return False
     else:
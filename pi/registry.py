@@ -0,0 +1,220 @@
+import os
+import re
+import json
+import time
+import base64
+import asyncio
+import logging
+import tempfile
+
+from pathlib import Path
+from functools import lru_cache
+from urllib.parse import urlsplit, urlencode
+
+from .auth import read_config, server_name, resolve_auth
+from .http import connect_tcp, HTTPError, ConnectionClosed
+from .utils import cache_dir
+
+
+log = logging.getLogger(__name__)
+
+DOCKER_HUB = 'docker.io'
+DOCKER_HUB_API = 'registry-1.docker.io'
+
+# registries, which are accessed using plain http, like Docker does
+_INSECURE_HOSTS = {'localhost', '127.0.0.1', '::1'}
+
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+])
+
+PROBE_TIMEOUT = 10
+
+# images may be pushed later, so they are not considered missing forever
+MISSING_TTL = 15 * 60
+
+_ERRORS = (OSError, HTTPError, ConnectionClosed, asyncio.TimeoutError,
+           ValueError, KeyError)
+
+_CHALLENGE_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def _split_name(name):
+    """Returns registry host, repository path and tag of the image"""
+    repository, sep, tag = name.rpartition(':')
+    if not sep or '/' in tag:
+        repository, tag = name, 'latest'
+    domain, _, path = repository.partition('/')
+    if path and ('.' in domain or ':' in domain or domain == 'localhost'):
+        return domain, path, tag
+    if '/' not in repository:
+        repository = 'library/' + repository
+    return DOCKER_HUB, repository, tag
+
+
+def _api_url(host):
+    if host == DOCKER_HUB:
+        host = DOCKER_HUB_API
+    hostname = urlsplit('//' + host).hostname
+    scheme = 'http' if hostname in _INSECURE_HOSTS else 'https'
+    return '{}://{}'.format(scheme, host)
+
+
+async def _request(method, url, headers=()):
+    url_parts = urlsplit(url)
+    secure = url_parts.scheme == 'https'
+    port = url_parts.port or (443 if secure else 80)
+    path = url_parts.path
+    if url_parts.query:
+        path += '?' + url_parts.query
+    async with connect_tcp(url_parts.hostname, port,
+                           secure=secure) as stream:
+        await stream.send_request(method, path, [
+            ('host', url_parts.netloc), *headers,
+        ])
+        response = await stream.recv_response()
+        body = b''.join([chunk async for chunk
+                         in stream.recv_data_chunked()])
+    return response, body
+
+
+def _parse_challenge(header):
+    scheme, _, params = header.partition(' ')
+    return scheme.lower(), dict(_CHALLENGE_PARAM_RE.findall(params))
+
+
+def _basic(auth):
+    credentials = '{}:{}'.format(auth['Username'], auth['Password'])
+    return 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode()
+
+
+class MissingCache:
+    """Persistent set of the images, which are known to be missing in their
+    registries. Entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, path, *, ttl=MISSING_TTL):
+        self._path = Path(path)
+        self._index_path = self._path / 'missing.json'
+        self._ttl = ttl
+        self._index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                                         dir=self._path, delete=False) as f:
+            json.dump(self._index, f)
+        os.replace(f.name, self._index_path)
+
+    def _expired(self, added):
+        return time.time() - added >= self._ttl
+
+    def __contains__(self, name):
+        added = self._index.get(name)
+        return added is not None and not self._expired(added)
+
+    def add(self, name):
+        self._index = {key: added for key, added in self._index.items()
+                       if not self._expired(added)}
+        self._index[name] = time.time()
+        self._write_index()
+
+    def discard(self, name):
+        if self._index.pop(name, None) is not None:
+            self._write_index()
+
+
+@lru_cache(maxsize=None)
+def missing_cache():
+    return MissingCache(cache_dir('registry'))
+
+
+class Registry:
+    """Checks existence of the images in their registries, without pulling
+    them, using Docker Registry HTTP API V2
+    """
+
+    def __init__(self, *, config=None, missing=None):
+        self._config = config
+        self._missing = missing
+        self._tokens = {}
+
+    async def _authorization(self, name, challenge):
+        scheme, params = _parse_challenge(challenge)
+        if self._config is None:
+            self._config = read_config()
+        auth = await resolve_auth(self._config, server_name(name))
+        if scheme == 'basic':
+            return _basic(auth) if auth is not None else None
+        elif scheme != 'bearer' or 'realm' not in params:
+            return None
+        query = {key: params[key] for key in ('service', 'scope')
+                 if key in params}
+        url = params['realm']
+        if query:
+            url += '?' + urlencode(query)
+        headers = [('authorization', _basic(auth))] if auth else []
+        response, body = await _request('GET', url, headers)
+        if response.status_code != 200:
+            response.error()
+        data = json.loads(body)
+        return 'Bearer ' + (data.get('token') or data['access_token'])
+
+    async def _head_manifest(self, name):
+        host, path, tag = _split_name(name)
+        url = '{}/v2/{}/manifests/{}'.format(_api_url(host), path, tag)
+        headers = [('accept', MANIFEST_TYPES)]
+        authorization = self._tokens.get((host, path))
+        if authorization is not None:
+            headers.append(('authorization', authorization))
+        response, _ = await _request('HEAD', url, headers)
+        challenge = response.headers.get(b'www-authenticate')
+        if response.status_code == 401 and challenge is not None:
+            authorization = await self._authorization(
+                name, challenge.decode('latin-1'),
+            )
+            if authorization is None:
+                return response.status_code
+            self._tokens[host, path] = authorization
+            headers = [('accept', MANIFEST_TYPES),
+                       ('authorization', authorization)]
+            response, _ = await _request('HEAD', url, headers)
+        return response.status_code
+
+    def discard_missing(self, docker_image):
+        """Should be called when image was pulled or pushed"""
+        if self._missing is not None:
+            self._missing.discard(docker_image.name)
+
+    async def exists(self, docker_image):
+        """Returns True or False when it is known whether image exists, or
+        None when registry can't tell
+        """
+        name = docker_image.name
+        if self._missing is not None and name in self._missing:
+            return False
+        try:
+            status_code = await asyncio.wait_for(self._head_manifest(name),
+                                                 PROBE_TIMEOUT)
+        except _ERRORS:
+            log.debug('Failed to check image %s', name, exc_info=True)
+            return None
+        if status_code == 200:
+            return True
+        elif status_code == 404:
+            if self._missing is not None:
+                self._missing.add(name)
+            return False
+        else:
+            log.debug('Unable to check image %s, status %d', name,
+                      status_code)
+            return None
@@ -1,9 +1,12 @@
+import time
 import asyncio
 import logging
 
 from typing import Optional
-from asyncio import Queue
-from itertools import chain
+from heapq import heappush, heappop
+from asyncio import Queue, wait, ensure_future
+from itertools import chain, count
+from functools import partial
 from collections import defaultdict
 from dataclasses import dataclass
 
@@ -28,16 +31,35 @@ class ImagesCollector:
         self._images_map = images_map
         self._services_map = services_map
         self._services_seen = set()
-        self._deps = set()
+        self._images = {}
+        self._docker_images = set()
 
     @classmethod
-    def collect(cls, images_map, services_map, obj):
+    def collect(cls, images_map, services_map, obj, *, versions=None):
+        versions = versions or images.ImageVersions(images_map)
         self = cls(images_map, services_map)
         self.visit(obj)
-        return list(self._deps)
+        return self.deps(versions)
+
+    @classmethod
+    async def collect_async(cls, images_map, services_map, obj, *, versions):
+        self = cls(images_map, services_map)
+        self.visit(obj)
+        await versions.prepare(self._images.values())
+        return self.deps(versions)
+
+    def deps(self, versions):
+        deps = {Dep(None, docker_image) for docker_image in self._docker_images}
+        deps.update(Dep(image, versions.docker_image(image.name))
+                    for image in self._images.values())
+        return list(deps)
 
     def visit(self, obj):
-        return obj.accept(self)
+        if isinstance(obj, (list, tuple)):
+            for item in obj:
+                self.visit(item)
+        else:
+            return obj.accept(self)
 
     def visit_meta(self, obj):
         pass
@@ -47,11 +69,10 @@ class ImagesCollector:
 
     def add(self, image):
         if isinstance(image, DockerImage):
-            self._deps.add(Dep(None, image))
+            self._docker_images.add(image)
         else:
             image = self._images_map.get(image)
-            version, = images.image_versions(self._images_map, [image])
-            self._deps.add(Dep(image, DockerImage.from_image(image, version)))
+            self._images[image.name] = image
             if image.from_ is not None:
                 self.add(image.from_)
 
@@ -75,16 +96,104 @@ PULL_DONE = MessageType('PULL_DONE')
 PULL_FAILED = MessageType('PULL_FAILED')
 BUILD_DONE = MessageType('BUILD_DONE')
 BUILD_FAILED = MessageType('BUILD_FAILED')
+CANCELLED = MessageType('CANCELLED')
+
+PULL = 'pull'
+BUILD = 'build'
 
 
-async def pull_worker(docker, queue, result_queue, *, status):
+class Report:
+    """Results and durations of the pull and build jobs"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, kind, dep, result, duration):
+        self.jobs.append({
+            'image': dep.docker_image.name,
+            'job': kind,
+            'result': result,
+            'duration': round(duration, 3),
+        })
+
+
+class Jobs:
+    """Runs pull and build jobs as separate tasks, so they can be cancelled
+    without cancelling workers
+    """
+
+    def __init__(self, *, report=None):
+        self._tasks = {}
+        self._cancelled = set()
+        self._report = report
+
+    def _add_report(self, kind, dep, task, started_at):
+        if task.cancelled():
+            result = 'cancelled'
+        elif task.exception() is not None or not task.result():
+            result = 'failed'
+        else:
+            result = 'done'
+        self._report.add(kind, dep, result, time.monotonic() - started_at)
+
+    async def run(self, kind, dep, coro):
+        key = (kind, dep)
+        if key in self._cancelled:
+            coro.close()
+            return CANCELLED
+        started_at = time.monotonic()
+        task = self._tasks[key] = ensure_future(coro)
+        if self._report is not None:
+            task.add_done_callback(partial(self._add_report, kind, dep,
+                                           started_at=started_at))
+        try:
+            await wait([task])
+        except asyncio.CancelledError:
+            await terminate(task)
+            raise
+        finally:
+            del self._tasks[key]
+        if task.cancelled():
+            return CANCELLED
+        return task.result()
+
+    def cancel(self, kind, dep):
+        self._cancelled.add((kind, dep))
+        task = self._tasks.get((kind, dep))
+        if task is not None:
+            task.cancel()
+
+
+async def _pull(docker, docker_image, *, status, registry=None, probe=False):
+    # registry check is much faster than a failed pull, but registry can be
+    # wrong, so it is trusted only when image can be built instead
+    if (
+        probe and registry is not None
+        and await registry.exists(docker_image) is False
+    ):
+        log.debug('Image %s is missing in the registry', docker_image.name)
+        return False
+    result = await images.pull(docker, docker_image, status=status)
+    if result and registry is not None:
+        registry.discard_missing(docker_image)
+    return result
+
+
+async def pull_worker(docker, queue, result_queue, *, status, jobs=None,
+                      registry=None, build=False):
+    jobs = jobs or Jobs()
     while True:
         dep = await queue.get()
         if dep.docker_image.name.startswith('localhost/'):
             await result_queue.put((PULL_FAILED, dep))
             continue
         try:
-            result = await images.pull(docker, dep.docker_image, status=status)
+            result = await jobs.run(PULL, dep, _pull(
+                docker, dep.docker_image, status=status, registry=registry,
+                probe=build and dep.image is not None,
+            ))
+            if result is CANCELLED:
+                continue
         except Exception:
             log.exception('Failed to pull image')
             await result_queue.put((PULL_FAILED, dep))
@@ -93,12 +202,18 @@ async def pull_worker(docker, queue, result_queue, *, status):
             await result_queue.put((task_status, dep))
 
 
-async def build_worker(docker, images_map, queue, result_queue, *, status):
+async def build_worker(docker, images_map, queue, result_queue, *, status,
+                       versions=None, build_backend=None, jobs=None):
+    jobs = jobs or Jobs()
     while True:
         dep = await queue.get()
         try:
-            result = await build_image(docker, images_map, dep.image,
-                                       status=status)
+            result = await jobs.run(BUILD, dep, build_image(
+                docker, images_map, dep.image, status=status,
+                versions=versions, backend=build_backend,
+            ))
+            if result is CANCELLED:
+                continue
         except Exception:
             log.exception('Failed to build image')
             await result_queue.put((BUILD_FAILED, dep))
@@ -141,7 +256,10 @@ def build_deps_map(plain_deps):
 
 
 async def check(client, dependencies):
-    available_images = await client.images()
+    if not dependencies:
+        return []
+    names = sorted({d.docker_image.name for d in dependencies})
+    available_images = await client.images(filters={'reference': names})
     repo_tags = set(chain.from_iterable(i['RepoTags'] or []
                                         for i in available_images))
     missing = [d for d in dependencies
@@ -149,39 +267,118 @@ async def check(client, dependencies):
     return missing
 
 
-def mark_working(deps_map, in_work, item):
-    deps_map.pop(item)
-    in_work.add(item)
-
-
-def mark_done(deps_map, in_work, item):
-    deps_map.pop(item, None)
-    for v in deps_map.values():
-        v.discard(item)
-    in_work.discard(item)
-
-
-def mark_failed(deps_map, in_work, item):
-    failed = [item]
-    deps_map.pop(item, None)
-    for k, v in list(deps_map.items()):
-        if item in v:
-            failed.extend(mark_failed(deps_map, in_work, k))
-    in_work.discard(item)
-    return failed
+class Scheduler:
+    """Dependency graph of the images to resolve
+
+    Items become ready when all their parents are done. Ready items with
+    the longest chain of dependent items are dispatched first, so long
+    chains are started as early as possible.
+    """
+
+    def __init__(self, deps_map):
+        self._dependents = defaultdict(set)
+        self._in_degree = {}
+        for item, parents in deps_map.items():
+            self._in_degree[item] = len(parents)
+            for parent in parents:
+                self._dependents[parent].add(item)
+        self._priority = self._critical_paths()
+        self._counter = count()
+        self._ready = []
+        self._in_work = set()
+        for item, in_degree in self._in_degree.items():
+            if not in_degree:
+                self._push(item)
+
+    def _critical_paths(self):
+        # topological order, parents first
+        in_degree = dict(self._in_degree)
+        order = [item for item, degree in in_degree.items() if not degree]
+        for item in order:
+            for child in self._dependents[item]:
+                in_degree[child] -= 1
+                if not in_degree[child]:
+                    order.append(child)
+        priority = {}
+        for item in reversed(order):
+            priority[item] = 1 + max((priority[child]
+                                      for child in self._dependents[item]),
+                                     default=0)
+        return priority
+
+    def _push(self, item):
+        heappush(self._ready, (-self._priority[item], next(self._counter),
+                               item))
+
+    @property
+    def active(self):
+        return bool(self._ready or self._in_work)
+
+    def pop_ready(self):
+        """Returns ready items in order of their priority"""
+        items = []
+        while self._ready:
+            _, _, item = heappop(self._ready)
+            self._in_work.add(item)
+            items.append(item)
+        return items
+
+    def done(self, item):
+        self._in_work.discard(item)
+        for child in self._dependents.pop(item, ()):
+            if child not in self._in_degree:
+                continue  # failed or cancelled
+            self._in_degree[child] -= 1
+            if not self._in_degree[child]:
+                self._push(child)
+
+    def failed(self, item):
+        """Returns failed item with all its dependent items"""
+        self._in_work.discard(item)
+        self._in_degree.pop(item, None)
+        failed = [item]
+        for failed_item in failed:
+            for child in self._dependents.pop(failed_item, ()):
+                if self._in_degree.pop(child, None) is not None:
+                    failed.append(child)
+        return failed
+
+    def cancel(self):
+        """Stops dispatching of the new items"""
+        self._ready.clear()
+        self._in_degree.clear()
+        self._dependents.clear()
 
 
 async def resolve(docker, images_map, services_map, obj, *,
-                  status, pull=False, build=False, fail_fast=False):
+                  status, pull=False, build=False, fail_fast=False,
+                  versions=None, build_backend=None, pull_jobs=1,
+                  build_jobs=1, speculate_after=None, registry=None,
+                  report=None):
+    """Pulls or builds missing images, required by the `obj`, which can be
+    an image, service, command or a list of them
+
+    When `speculate_after` is set, image is also built if its pull takes
+    more than this number of seconds, whichever finishes first is used and
+    the other one is cancelled.
+
+    When `registry` is set, images which can be built are pulled only if
+    they may exist in their registries, otherwise they are built right
+    away.
+
+    When `report` is set, results and durations of all the pulls and
+    builds are added into it.
+    """
     loop = asyncio.get_running_loop()
-    deps = ImagesCollector.collect(images_map, services_map, obj)
+    versions = versions or images.ImageVersions(images_map)
+    deps = await ImagesCollector.collect_async(images_map, services_map, obj,
+                                               versions=versions)
     missing = await check(docker, deps)
     if not missing or not (pull or build):
         return missing
 
     failed = []
-    deps_map = build_deps_map(missing)
-    in_work = set()
+    scheduler = Scheduler(build_deps_map(missing))
 
     # check existence of all images
 
@@ -189,44 +386,87 @@ async def resolve(docker, images_map, services_map, obj, *,
     build_queue = Queue()
     result_queue = Queue()
 
-    puller_task = loop.create_task(
-        pull_worker(docker, pull_queue, result_queue, status=status)
-    )
-    builder_task = loop.create_task(
-        build_worker(docker, images_map, build_queue, result_queue,
-                     status=status)
+    jobs = Jobs(report=report)
+    # running and started jobs of every item
+    running = defaultdict(set)
+    started = defaultdict(set)
+    timers = {}
+
+    def start(kind, dep):
+        running[dep].add(kind)
+        started[dep].add(kind)
+        queue = pull_queue if kind is PULL else build_queue
+        queue.put_nowait(dep)
+
+    def speculate(dep):
+        timers.pop(dep, None)
+        if PULL in running[dep] and BUILD not in started[dep]:
+            log.debug('Pull of %s is slow, building it', dep.docker_image)
+            start(BUILD, dep)
+
+    def finish(dep):
+        timer = timers.pop(dep, None)
+        if timer is not None:
+            timer.cancel()
+        for kind in running.pop(dep, ()):
+            jobs.cancel(kind, dep)
+
+    # workers are draining the same queues
+    worker_tasks = [
+        loop.create_task(
+            pull_worker(docker, pull_queue, result_queue, status=status,
+                        jobs=jobs, registry=registry, build=build)
+        )
+        for _ in range(pull_jobs)
+    ]
+    worker_tasks.extend(
+        loop.create_task(
+            build_worker(docker, images_map, build_queue, result_queue,
+                         status=status, versions=versions,
+                         build_backend=build_backend, jobs=jobs)
+        )
+        for _ in range(build_jobs)
     )
     try:
-        while deps_map or in_work:
+        while scheduler.active:
             # enqueue all tasks with resolved dependencies
-            batch = [k for k, v in deps_map.items() if not v]
-            init_queue = pull_queue if pull else build_queue
-            for item in batch:
-                mark_working(deps_map, in_work, item)
-                await init_queue.put(item)
-
-            result, dep = await result_queue.get()
-
-            if result is PULL_DONE:
-                mark_done(deps_map, in_work, dep)
-
-            elif result is PULL_FAILED:
-                if build and dep.image is not None:
-                    await build_queue.put(dep)
+            for item in scheduler.pop_ready():
+                if pull:
+                    start(PULL, item)
+                    if (
+                        speculate_after is not None
+                        and build and item.image is not None
+                    ):
+                        timers[item] = loop.call_later(speculate_after,
+                                                       speculate, item)
                 else:
-                    failed.extend(mark_failed(deps_map, in_work, dep))
-                    if fail_fast:
-                        deps_map.clear()
-
-            elif result is BUILD_DONE:
-                mark_done(deps_map, in_work, dep)
+                    start(BUILD, item)
 
-            elif result is BUILD_FAILED:
-                failed.extend(mark_failed(deps_map, in_work, dep))
+            result, dep = await result_queue.get()
+            if dep not in running:
+                continue  # already resolved or failed
+
+            if result is PULL_DONE or result is BUILD_DONE:
+                finish(dep)
+                scheduler.done(dep)
+                continue
+
+            running[dep].discard(PULL if result is PULL_FAILED else BUILD)
+            if (
+                result is PULL_FAILED
+                and build and dep.image is not None
+                and BUILD not in started[dep]
+            ):
+                start(BUILD, dep)
+            elif not running[dep]:
+                finish(dep)
+                failed.extend(scheduler.failed(dep))
                 if fail_fast:
-                    deps_map.clear()
+                    scheduler.cancel()
 
     finally:
-        await terminate(puller_task)
-        await terminate(builder_task)
+        for timer in timers.values():
+            timer.cancel()
+        for task in worker_tasks:
+            await terminate(task)
     return failed
@@ -61,7 +61,8 @@ def _port_binds(ports):
 
 async def start(docker, image, command, *, init=None, tty=True,
                 entrypoint=None, volumes=None, ports=None, environ=None,
-                work_dir=None, network=None, network_alias=None, label=None):
+                work_dir=None, network=None, network_alias=None, label=None,
+                labels=None):
     spec = {
         'Image': image.name,
         'Cmd': command,
@@ -78,8 +79,10 @@ async def start(docker, image, command, *, init=None, tty=True,
         spec['Entrypoint'] = entrypoint
     if work_dir:
         spec['WorkingDir'] = os.path.abspath(work_dir)
-    if label:
-        spec['Labels'] = {label: ''}
+    if label or labels:
+        spec['Labels'] = dict(labels or {})
+        if label:
+            spec['Labels'][label] = ''
 
     host_config = {}
     if init:
@@ -1,16 +1,28 @@
-from .utils import search_container
 from .types import Service, LocalPath, Mode
 
 
+# shared by all service containers of the namespace
+NAMESPACE_LABEL = 'pi-namespace'
+
+
 def service_label(namespace: str, service: Service):
     return '{}-{}'.format(namespace, service.name)
 
 
+def namespace_labels(namespace: str):
+    return {NAMESPACE_LABEL: namespace}
+
+
+def namespace_filter(namespace: str):
+    return '{}={}'.format(NAMESPACE_LABEL, namespace)
+
+
 async def ensure_running(docker, namespace, services):
-    containers = await docker.containers(params={'all': 'true'})
     for service in services:
         label = service_label(namespace, service)
-        container = next(search_container(label, containers), None)
+        containers = await docker.containers(params={'all': 'true'},
+                                             filters={'label': label})
+        container = next(iter(containers), None)
         if container is None:
             # TODO: Create container
             raise RuntimeError('Service {} is not running'
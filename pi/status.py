@@ -1,14 +1,38 @@
 import sys
-from collections import defaultdict
+import asyncio
+
+
+# terminal is redrawn at most this number of times per second
+FRAME_RATE = 15
+
+# changed lines are written at most once per this interval, when output is
+# not a terminal
+PLAIN_INTERVAL = 1
 
 
 class Status:
-    def __init__(self, *, output=sys.stdout):
-        self._idx = []
-        self._steps = defaultdict(list)
+    """Displays tasks and their steps, every task is a block of lines
+
+    Changes are coalesced and rendered by frames, so frequent updates do
+    not make terminal output a bottleneck. When output is not a terminal,
+    lines are written one after another, without cursor movements.
+    """
+
+    def __init__(self, *, output=sys.stdout, tty=None):
+        self._output = output
+        self._tty = output.isatty() if tty is None else tty
+        self._interval = 1 / FRAME_RATE if self._tty else PLAIN_INTERVAL
+        self._blocks = {}
         self._titles = {}
+        self._dirty = {}  # ordered set
+        self._handle = None
+        # rendered state
+        self._lines = []
+        self._pos = {}
+        self._height = 0
         self._current = 0
-        self._output = output
+        self._written = {}
+        self._layout_changed = False
 
     def _up(self, count):
         self._output.write(f'{chr(27)}[{count}A')
@@ -27,57 +51,90 @@ class Status:
             self._up(-count)
         self._current = to
 
-    def _newline(self):
-        self._output.write('\n')
-        self._current += 1
+    def _layout(self):
+        lines = [key for block in self._blocks.values() for key in block]
+        # lines are only added, so everything after the first moved line
+        # should be redrawn
+        first_moved = len(self._lines)
+        for i, (old, new) in enumerate(zip(self._lines, lines)):
+            if old is not new:
+                first_moved = i
+                break
+        self._lines = lines
+        self._pos = {key: i for i, key in enumerate(lines)}
+        self._layout_changed = False
+        return first_moved
+
+    def _render_tty(self):
+        redraw = set()
+        if self._layout_changed:
+            redraw.update(range(self._layout(), len(self._lines)))
+        redraw.update(self._pos[key] for key in self._dirty)
+        if len(self._lines) > self._height:
+            # there is always an empty line after the last one
+            self._move(self._height)
+            self._output.write('\n' * (len(self._lines) - self._height))
+            self._current += len(self._lines) - self._height
+            self._height = len(self._lines)
+        for pos in sorted(redraw):
+            self._move(pos)
+            self._erase()
+            self._output.write(self._titles[self._lines[pos]])
+
+    def _render_plain(self):
+        for key in self._dirty:
+            title = self._titles[key]
+            if self._written.get(key) != title:
+                self._written[key] = title
+                self._output.write(title + '\n')
+
+    def _render(self):
+        self._handle = None
+        if self._tty:
+            self._render_tty()
+        else:
+            self._render_plain()
+        self._dirty.clear()
+        self._output.flush()
 
-    def _refresh(self, key):
-        self._move(self._idx.index(key))
-        self._erase()
-        self._output.write(self._titles[key])
+    def _changed(self, key):
+        self._dirty[key] = None
+        if self._handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._render()
+            else:
+                self._handle = loop.call_later(self._interval, self._render)
 
     def add_task(self, title):
-        self._move(len(self._idx))
-        self._newline()
-
         key = object()
-        self._idx.append(key)
+        self._blocks[key] = [key]
         self._titles[key] = title
-        self._refresh(key)
-
-        self._output.flush()
+        self._layout_changed = True
+        self._changed(key)
         return key
 
     def add_step(self, task_key, title):
-        if task_key in self._steps:
-            append_after = self._steps[task_key][-1]
-        else:
-            append_after = task_key
-
-        insert_pos = self._idx.index(append_after) + 1
-
         key = object()
-        self._idx.insert(insert_pos, key)
-        self._steps[task_key].append(key)
+        self._blocks[task_key].append(key)
         self._titles[key] = title
-
-        # rerender
-        for key in self._idx[insert_pos:]:
-            self._refresh(key)
-        self._newline()
-
-        self._output.flush()
+        self._layout_changed = True
+        self._changed(key)
         return key
 
     def update(self, key, title):
         self._titles[key] = title
-        self._refresh(key)
-        self._output.flush()
+        self._changed(key)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._move(len(self._idx))
-        self._erase()
-        self._output.flush()
+        if self._handle is not None:
+            self._handle.cancel()
+        self._render()
+        if self._tty:
+            self._move(self._height)
+            self._erase()
+            self._output.flush()
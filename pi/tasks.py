@@ -1,6 +1,7 @@
 import io
 import os
 import sys
+import json
 import math
 import uuid
 import tarfile
@@ -9,24 +10,29 @@ import hashlib
 import asyncio
 import tempfile
 import unicodedata
+from stat import S_ISLNK, S_ISREG
 from typing import Optional
+from itertools import chain
 from pathlib import Path
+from contextlib import asynccontextmanager
 from asyncio import wait, Queue, Event, gather, FIRST_EXCEPTION, WriteTransport
 from dataclasses import dataclass, field
-from urllib.parse import urlsplit
-from concurrent.futures import ProcessPoolExecutor
 
 from ._requires import jinja2
 
 from .run import StdIOProtocol
-from .http import connect_tcp
+from .http import NDJSONDecoder
+from .download import fetch, download_cache
 from .types import ActionType
-from .utils import terminate
-from .images import docker_image, image_versions
+from .utils import terminate, process_pool
+from .images import ImageVersions
 
 
 log = logging.getLogger(__name__)
 
+EXEC_BACKEND = 'exec'
+DOCKERFILE_BACKEND = 'dockerfile'
+
 
 @dataclass
 class Result:
@@ -36,6 +42,12 @@ class Result:
     def value(self):
         return hashlib.sha1(self.file.name.encode('utf-8')).hexdigest()
 
+    def reuse(self, file, uuid):
+        """Replaces result with an already existing archive"""
+        self.file.close()
+        self.file = file
+        self.uuid = uuid
+
     def close(self):
         self.file.close()
 
@@ -47,50 +59,10 @@ class ActionState:
     error: Optional[str] = None
 
 
-async def _download(url, output, *, _max_redirects=5):
-    redirects = 0
-    initial_url = url
-    initial_secure = None
-    while redirects < _max_redirects:
-        url_parts = urlsplit(url)
-
-        secure = True if url_parts.scheme == 'https' else False
-        if redirects == 0:
-            initial_secure = secure
-        if initial_secure is True and secure is False:
-            raise Exception(f'Redirect to insecure url: {url}')
-
-        host, _, port = url_parts.netloc.partition(':')
-        if not port:
-            port = 443 if url_parts.scheme == 'https' else 80
-        else:
-            port = int(port)
-        path = url_parts.path
-        if url_parts.query:
-            path += '?' + url_parts.query
-
-        async with connect_tcp(host, port, secure=secure) as stream:
-            await stream.send_request('GET', path, [
-                ('host', url_parts.netloc),
-            ])
-            response = await stream.recv_response()
-            if response.status_code in {301, 302}:
-                url = response.headers[b'location'].decode('ascii')
-                redirects += 1
-                continue
-            elif response.status_code != 200:
-                response.error()
-            async for chunk in stream.recv_data_chunked():
-                output.write(chunk)
-            break
-    else:
-        raise Exception(f'More than {_max_redirects} redirects: {initial_url}')
-
-
 async def download(url, file_name, destination):
     with tempfile.NamedTemporaryFile() as tmp:
         with tarfile.open(file_name, mode='w:tar') as tar:
-            await _download(url, tmp)
+            await fetch(url, tmp)
             tmp.seek(0)
             tar.addfile(tar.gettarinfo(arcname=destination, fileobj=tmp),
                         fileobj=tmp)
@@ -128,12 +100,21 @@ def bundle(action_path, file_name, destination):
             for name in names:
                 file_abs_path = os.path.join(abs_path, name)
                 file_rel_path = str(rel_path.joinpath(name))
-                with open(file_abs_path, 'rb') as f:
-                    tar.addfile(
-                        tar.gettarinfo(arcname=_arc_path(str(file_rel_path)),
-                                       fileobj=f),
-                        fileobj=f,
-                    )
+                mode = os.lstat(file_abs_path).st_mode
+                if S_ISLNK(mode):
+                    # symlinks are packed as is, they may be dangling
+                    tar.addfile(tar.gettarinfo(
+                        file_abs_path, _arc_path(str(file_rel_path)),
+                    ))
+                elif S_ISREG(mode):
+                    with open(file_abs_path, 'rb') as f:
+                        tar.addfile(
+                            tar.gettarinfo(
+                                arcname=_arc_path(str(file_rel_path)),
+                                fileobj=f,
+                            ),
+                            fileobj=f,
+                        )
 
 
 def iter_actions(task):
@@ -186,16 +167,23 @@ class ActionDispatcher:
 
 class IOExecutor:
 
+    def __init__(self, cache=None):
+        self.cache = cache
+
     def visit(self, action):
         return action.accept(self)
 
     async def download(self, action, state):
         try:
-            await download(
-                action.url,
-                state.result.file.name,
-                state.result.uuid,
-            )
+            if self.cache is not None:
+                digest, path = await self.cache.fetch(action.url)
+                state.result.reuse(open(path, 'rb'), digest)
+            else:
+                await download(
+                    action.url,
+                    state.result.file.name,
+                    state.result.uuid,
+                )
         except Exception as err:
             log.debug('Download action failed: %r', action, exc_info=True)
             state.error = str(err)
@@ -311,46 +299,197 @@ async def _exec(docker, id_, cmd):
     return exit_code
 
 
-async def build_image(docker, images_map, image, *, status):
+async def _cached_layers(docker, layers):
+    """Returns number of tasks, which results are already available"""
+    if not layers:
+        return 0
+    available = await docker.images(filters={
+        'reference': [layer.name for layer in layers],
+    })
+    repo_tags = set(chain.from_iterable(i['RepoTags'] or []
+                                        for i in available))
+    # each layer depends on all previous tasks, so the latest one is enough
+    for i in range(len(layers), 0, -1):
+        if layers[i - 1].name in repo_tags:
+            return i
+    return 0
+
+
+async def _commit(docker, id_, docker_image):
+    repo, _, tag = docker_image.name.rpartition(':')
+    await docker.pause(id_)
+    await docker.commit(params={'container': id_, 'repo': repo, 'tag': tag})
+    await docker.unpause(id_)
+
+
+@asynccontextmanager
+async def _task_container(docker, base):
+    """Container for a single task, so its commit contains only changes,
+    made by this task, and the parent of the committed image is the base
+    """
+    create = asyncio.ensure_future(docker.create_container({
+        'Image': base.name,
+        'Cmd': '/bin/sh',
+        'Tty': True,
+        'AttachStdout': False,
+        'AttachStderr': False,
+    }))
+    try:
+        c = await asyncio.shield(create)
+    except asyncio.CancelledError:
+        # container is created anyway, so it should be removed
+        c = await create
+        await docker.remove_container(c['Id'], params={'v': 'true',
+                                                       'force': 'true'})
+        raise
+    try:
+        await docker.start(c['Id'])
+        yield c['Id']
+    finally:
+        await docker.remove_container(c['Id'], params={'v': 'true',
+                                                       'force': 'true'})
+
+
+def _action_id(action):
+    return hashlib.sha1(repr(action).encode('utf-8')).hexdigest()
+
+
+def dockerfile(from_, tasks, results):
+    lines = ['FROM {}'.format(from_.name)]
+    for task in tasks:
+        task_results = {}
+        for action in iter_actions(task):
+            path = '.pi/{}'.format(results[action])
+            lines.append('COPY {}'.format(json.dumps([path, '/' + path])))
+            task_results[action] = '/' + path
+        # action results are hidden from the final filesystem, but still
+        # stored in the COPY layers, so the image grows by their size
+        cmd = '(\n{}\n) && rm -rf /.pi'.format(task_cmd(task, task_results))
+        lines.append('RUN {}'.format(json.dumps(['/bin/sh', '-c', cmd])))
+    return '\n'.join(lines) + '\n'
+
+
+def build_context(file, dockerfile_, archives):
+    with tarfile.open(fileobj=file, mode='w:tar') as context:
+        data = dockerfile_.encode('utf-8')
+        info = tarfile.TarInfo('Dockerfile')
+        info.size = len(data)
+        context.addfile(info, io.BytesIO(data))
+        for archive in archives:
+            archive.seek(0)
+            with tarfile.open(fileobj=archive, mode='r:') as tar:
+                for member in tar:
+                    fileobj = None
+                    if member.isreg():
+                        fileobj = tar.extractfile(member)
+                    member.name = '.pi/{}'.format(member.name)
+                    context.addfile(member, fileobj)
+
+
+async def _build_dockerfile(docker, image, version, from_, *, status,
+                            task_key):
     loop = asyncio.get_running_loop()
-    version, = image_versions(images_map, [image])
-    from_ = docker_image(images_map, image.from_)
+    io_queue = Queue()
+    io_executor = IOExecutor(download_cache())
+
+    cpu_queue = Queue()
+    cpu_executor = CPUExecutor(process_pool())
+
+    states = get_action_states(image.tasks)
+    for action, state in states.items():
+        # stable paths, so the Docker's build cache can be used
+        state.result.uuid = _action_id(action)
+
+    io_pool_task = loop.create_task(pool(io_queue, io_executor))
+    cpu_pool_task = loop.create_task(pool(cpu_queue, cpu_executor))
+    try:
+        await ActionDispatcher.dispatch(states, io_queue, cpu_queue)
+        await wait_actions(states)
+        errors = {action: state.error for action, state in states.items()
+                  if state.error is not None}
+        if errors:
+            raise Exception(repr(errors))
+
+        results = {action: state.result.uuid
+                   for action, state in states.items()}
+        dockerfile_ = dockerfile(from_, image.tasks, results)
+        with tempfile.TemporaryFile() as context:
+            await loop.run_in_executor(
+                None, build_context, context, dockerfile_,
+                [state.result.file for state in states.values()],
+            )
+            context.seek(0)
+            params = {
+                't': '{}:{}'.format(image.repository, version),
+                'rm': 'true',
+                'forcerm': 'true',
+            }
+            decoder = NDJSONDecoder()
+            async for chunk in docker.build(context, params=params):
+                for event in decoder.feed(chunk):
+                    if 'error' in event:
+                        print(event['error'], file=sys.stderr)
+                        return False
+                    line = event.get('stream', '').strip()
+                    if line.startswith('Step '):
+                        status.add_step(task_key, line)
+        return True
+    finally:
+        await terminate(io_pool_task)
+        await terminate(cpu_pool_task)
+        for state in states.values():
+            state.result.close()
+
+
+async def build_image(docker, images_map, image, *, status, versions=None,
+                      backend=None):
+    loop = asyncio.get_running_loop()
+    versions = versions or ImageVersions(images_map)
+    await versions.prepare([image])
+    version = versions.version(image)
+    from_ = versions.docker_image(image.from_)
+
+    backend = image.build_backend or backend or EXEC_BACKEND
+    if backend not in {EXEC_BACKEND, DOCKERFILE_BACKEND}:
+        raise ValueError('Unknown build backend: {!r}'.format(backend))
 
     task_key = status.add_task('=> Building image {}:{} ({})'
                                .format(image.repository, version, image.name))
 
+    if backend == DOCKERFILE_BACKEND:
+        return await _build_dockerfile(docker, image, version, from_,
+                                       status=status, task_key=task_key)
+
+    # layers are hashed using file digests, so event loop is not blocked
+    layers = await loop.run_in_executor(None, versions.layers, image)
+    cached = await _cached_layers(docker, layers)
+    total = len(image.tasks)
+    if cached:
+        status.add_step(task_key, 'Using cached results of {}/{} tasks'
+                        .format(cached, total))
+    base = layers[cached - 1] if cached else from_
+    if cached == total:
+        await docker.tag(base.name, params={'repo': image.repository,
+                                            'tag': version})
+        return True
+
     io_queue = Queue()
-    io_executor = IOExecutor()
+    io_executor = IOExecutor(download_cache())
 
-    process_pool = ProcessPoolExecutor()
     cpu_queue = Queue()
-    cpu_executor = CPUExecutor(process_pool)
+    cpu_executor = CPUExecutor(process_pool())
 
-    states = get_action_states(image.tasks)
-    submitted_states = set()
+    states = get_action_states(image.tasks[cached:])
 
     io_pool_task = loop.create_task(pool(io_queue, io_executor))
     cpu_pool_task = loop.create_task(pool(cpu_queue, cpu_executor))
 
-    c = await docker.create_container({
-        'Image': from_.name,
-        'Cmd': '/bin/sh',
-        'Tty': True,
-        'AttachStdout': False,
-        'AttachStderr': False,
-    })
     try:
-        await docker.start(c['Id'])
-        exit_code = await _exec(docker, c['Id'], ['mkdir', '/.pi'])
-        if exit_code:
-            return False
-
         await ActionDispatcher.dispatch(states, io_queue, cpu_queue)
 
-        total = len(image.tasks)
         padding = math.ceil(math.log10(total + 1))
 
-        for i, task in enumerate(image.tasks, 1):
+        for i, task in enumerate(image.tasks[cached:], cached + 1):
             task_states = {action: states[action]
                            for action in iter_actions(task)}
 
@@ -365,41 +504,38 @@ async def build_image(docker, images_map, image, *, status):
             task_results = {action: '/.pi/{}'.format(state.result.uuid)
                             for action, state in task_states.items()}
 
-            for action, state in task_states.items():
-                if action not in submitted_states:
-                    with open(state.result.file.name, 'rb') as tar:
-                        await docker.put_archive(c['Id'], tar, params={
-                            'path': '/.pi',
-                        })
-                    submitted_states.add(action)
-
-            cmd = task_cmd(task, task_results)
-            current_index = '{{:{}d}}'.format(padding).format(i)
-            status.add_step(
-                task_key, '[{}/{}] {}'.format(current_index, total, cmd),
-            )
-            exit_code = await _exec(docker, c['Id'], cmd)
-            if exit_code:
-                return False
-
-        exit_code = await _exec(docker, c['Id'], ['rm', '-rf', '/.pi'])
-        if exit_code:
-            return False
-
-        await docker.pause(c['Id'])
-        await docker.commit(params={
-            'container': c['Id'],
-            'repo': image.repository,
-            'tag': version,
-        })
-        await docker.unpause(c['Id'])
+            async with _task_container(docker, base) as id_:
+                exit_code = await _exec(docker, id_, ['mkdir', '/.pi'])
+                if exit_code:
+                    return False
+
+                for state in task_states.values():
+                    state.result.file.seek(0)
+                    await docker.put_archive(id_, state.result.file,
+                                             params={'path': '/.pi'})
+
+                cmd = task_cmd(task, task_results)
+                current_index = '{{:{}d}}'.format(padding).format(i)
+                status.add_step(
+                    task_key, '[{}/{}] {}'.format(current_index, total, cmd),
+                )
+                exit_code = await _exec(docker, id_, cmd)
+                if exit_code:
+                    return False
+
+                # layers should not contain action results
+                exit_code = await _exec(docker, id_, ['rm', '-rf', '/.pi'])
+                if exit_code:
+                    return False
+                await _commit(docker, id_, layers[i - 1])
+            base = layers[i - 1]
+
+        await docker.tag(base.name, params={'repo': image.repository,
+                                            'tag': version})
         return True
 
     finally:
         await terminate(io_pool_task)
         await terminate(cpu_pool_task)
-        process_pool.shutdown()
         for state in states.values():
             state.result.close()
-        await docker.remove_container(c['Id'],
-                                      params={'v': 'true', 'force': 'true'})
@@ -63,9 +63,13 @@ class MappingConstruct:
 @dataclass(frozen=True)
 class Meta(MappingConstruct):
     __tag__ = '!Meta'
+    __rename_to__ = ImmutableDict([
+        ('build-backend', 'build_backend'),
+    ])
 
     namespace: Optional[str] = None
     description: Optional[str] = None
+    build_backend: Optional[str] = None
 
     def accept(self, visitor):
         return visitor.visit_meta(self)
@@ -107,6 +111,7 @@ class Image(MappingConstruct):
     __rename_to__ = ImmutableDict([
         ('from', 'from_'),
         ('tasks', '_tasks'),
+        ('build-backend', 'build_backend'),
     ])
 
     name: str
@@ -114,6 +119,7 @@ class Image(MappingConstruct):
     from_: Optional[Union[str, DockerImage]] = None
     _tasks: Sequence[Any] = field(default=(), hash=False)
     description: Optional[str] = None
+    build_backend: Optional[str] = None
 
     def accept(self, visitor):
         return visitor.visit_image(self)
@@ -1,12 +1,61 @@
+import os
 import sys
 import signal
 import asyncio
 
 from .._requires import click
+from ..utils import shutdown_process_pool
+from ..download import close_pools
 
 
 SIGNALS = (signal.SIGINT, signal.SIGTERM)
 
+PULL_JOBS = 4
+BUILD_JOBS = 2
+
+_JOBS = [
+    ('pull_jobs', 'PI_PULL_JOBS', click.IntRange(min=1), PULL_JOBS,
+     'Number of concurrent pulls'),
+    ('build_jobs', 'PI_BUILD_JOBS', click.IntRange(min=1), BUILD_JOBS,
+     'Number of concurrent builds'),
+    ('speculate_after', 'PI_SPECULATE_AFTER', click.FloatRange(min=0), None,
+     'Also build image, when its pull takes more than this number of '
+     'seconds, and use whichever finishes first'),
+]
+
+
+def _jobs_options():
+    for name, envvar, type_, default, help_ in _JOBS:
+        yield ['--{}'.format(name.replace('_', '-'))], dict(
+            type=type_, default=default, envvar=envvar,
+            show_default=default is not None, help=help_,
+        )
+
+
+def jobs_options():
+    """Options to configure concurrency of the dependencies resolution"""
+    return [click.Option(decls, **attrs)
+            for decls, attrs in _jobs_options()]
+
+
+def with_jobs_options(func):
+    for decls, attrs in reversed(list(_jobs_options())):
+        func = click.option(*decls, **attrs)(func)
+    return func
+
+
+def pop_jobs(params):
+    """Returns concurrency options, which are not available as command
+    line options for proxy commands, so they are read from environment
+    """
+    jobs = {}
+    for name, envvar, type_, default, _ in _JOBS:
+        value = params.pop(name, None)
+        if value is None and os.environ.get(envvar):
+            value = type_.convert(os.environ[envvar], None, None)
+        jobs[name] = default if value is None else value
+    return jobs
+
 
 class ExtGroup(click.Group):
 
@@ -41,6 +90,11 @@ async def _invoke(callback, *args, **kwargs):
     finally:
         for sig_num in SIGNALS:
             loop.remove_signal_handler(sig_num)
+        ctx = click.get_current_context(silent=True)
+        if ctx is not None and ctx.obj is not None:
+            ctx.obj.close()
+        close_pools()
+        shutdown_process_pool()
 
 
 def _async(callback):
@@ -7,7 +7,6 @@ from .._requires import jinja2
 
 from ..run import run
 from ..types import Command, LocalPath, Mode
-from ..images import docker_image
 from ..status import Status
 from ..console import config_tty
 from ..network import ensure_network
@@ -15,6 +14,7 @@ from ..resolve import resolve
 from ..services import ensure_running
 
 from .common import AsyncProxyCommand, AsyncCommand
+from .common import jobs_options, pop_jobs
 
 
 def create_groups(groups_parts):
@@ -102,6 +102,7 @@ async def _start_services(env, command):
 
 
 async def _callback(command, env, **params):
+    jobs = pop_jobs(params)
     with Status() as status:
         failed = await resolve(
             env.docker,
@@ -111,6 +112,10 @@ async def _callback(command, env, **params):
             status=status,
             pull=True,
             build=True,
+            versions=env.versions,
+            build_backend=env.build_backend,
+            registry=env.registry,
+            **jobs,
         )
     if failed:
         click.echo('Failed to resolve dependencies')
@@ -119,7 +124,7 @@ async def _callback(command, env, **params):
     await _start_services(env, command)
     await ensure_network(env.docker, env.network)
 
-    di = docker_image(env.images, command.image)
+    di = env.versions.docker_image(command.image)
     volumes = [LocalPath('.', '.', Mode.RW)]
 
     if isinstance(command.run, str):
@@ -157,6 +162,7 @@ def create_command(name, command):
         params_creator = _ParameterCreator()
         params = [params_creator.visit(param)
                   for param in (command.params or [])]
+        params.extend(jobs_options())
         return AsyncCommand(name, params=params, callback=callback,
                             help=command.description,
                             short_help=short_help)
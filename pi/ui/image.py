@@ -1,4 +1,7 @@
 import sys
+import json
+import time
+import asyncio
 
 from operator import attrgetter
 from collections import defaultdict
@@ -7,44 +10,83 @@ from collections import Counter, namedtuple
 from ..run import run
 from ..types import DockerImage, Mode, LocalPath
 from ..utils import format_size
-from ..images import pull, push, docker_image
-from ..images import image_versions
+from ..images import pull, push, layers_repository
 from ..status import Status
 from ..console import pretty, config_tty
-from ..resolve import resolve
+from ..resolve import resolve, Report
 
 from .._requires import click
 
-from .common import ExtGroup, AsyncCommand
+from .common import ExtGroup, AsyncCommand, with_jobs_options
+
+
+def _write_report(path, report, failed, duration):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'duration': round(duration, 3),
+            'failed': sorted(dep.docker_image.name for dep in failed),
+            'jobs': report.jobs,
+        }, f, indent=2)
 
 
 @click.command('build', help='Build image', cls=AsyncCommand)
-@click.argument('name')
+@click.argument('name', required=False)
+@click.option('--all', 'all_', is_flag=True,
+              help='Build all images, required by images, services and '
+                   'commands')
+@click.option('--report', type=click.Path(dir_okay=False, writable=True),
+              help='Write JSON report of pulls and builds into this file')
+@with_jobs_options
 @click.pass_obj
-async def image_build(env, name):
-    image = env.images.get(name)
+async def image_build(env, name, all_, report, pull_jobs, build_jobs,
+                      speculate_after):
+    if all_ == (name is not None):
+        click.echo('Either image name or --all option should be specified')
+        sys.exit(1)
+    if all_:
+        obj = [*env.images, *env.services, *env.commands]
+    else:
+        obj = env.images.get(name)
+    jobs_report = Report()
+    started_at = time.monotonic()
     with Status() as status:
         failed = await resolve(
             env.docker,
             env.images,
             env.services,
-            image,
+            obj,
             status=status,
             pull=True,
             build=True,
+            versions=env.versions,
+            build_backend=env.build_backend,
+            pull_jobs=pull_jobs,
+            build_jobs=build_jobs,
+            speculate_after=speculate_after,
+            registry=env.registry,
+            report=jobs_report,
         )
+    if report is not None:
+        _write_report(report, jobs_report, failed,
+                      time.monotonic() - started_at)
     if failed:
-        click.echo('Failed to build image {}'.format(name))
+        if all_:
+            click.echo('Failed to build images: {}'.format(', '.join(
+                sorted(dep.docker_image.name for dep in failed)
+            )))
+        else:
+            click.echo('Failed to build image {}'.format(name))
         sys.exit(1)
 
 
-def _get_image(images_map, name):
+async def _get_image(versions, name):
     try:
-        image = images_map.get(name)
+        image = versions.images_map.get(name)
     except KeyError:
         return DockerImage(name)
     else:
-        return docker_image(images_map, image.name)
+        await versions.prepare([image])
+        return versions.docker_image(image.name)
 
 
 @click.command('info', help='Show image info', cls=AsyncCommand)
@@ -58,7 +100,8 @@ async def image_info(env, name, repo_tag):
         click.echo('Unknown image name: {}'.format(name))
         sys.exit(1)
     if repo_tag:
-        version, = image_versions(env.images, [image])
+        await env.versions.prepare([image])
+        version = env.versions.version(image)
         click.echo('{}:{}'.format(image.repository, version))
     else:
         click.echo('Nothing')
@@ -69,10 +112,12 @@ async def image_info(env, name, repo_tag):
 @click.argument('name')
 @click.pass_obj
 async def image_pull(env, name):
-    image = _get_image(env.images, name)
+    image = await _get_image(env.versions, name)
     with Status() as status:
         success = await pull(env.docker, image, status=status)
-    if not success:
+    if success:
+        env.registry.discard_missing(image)
+    else:
         click.echo('Unable to pull image {}'.format(image.name))
         sys.exit(1)
 
@@ -81,10 +126,12 @@ async def image_pull(env, name):
 @click.argument('name')
 @click.pass_obj
 async def image_push(env, name):
-    image = _get_image(env.images, name)
+    image = await _get_image(env.versions, name)
     with Status() as status:
         success = await push(env.docker, image, status=status)
-    if not success:
+    if success:
+        env.registry.discard_missing(image)
+    else:
         click.echo('Unable to push image {}'.format(image.name))
         sys.exit(1)
 
@@ -94,7 +141,7 @@ async def image_push(env, name):
 @click.argument('args', nargs=-1, required=True)
 @click.pass_obj
 async def image_run(env, name, args):
-    image = _get_image(env.images, name)
+    image = await _get_image(env.versions, name)
     volumes = [LocalPath('.', '.', Mode.RW)]
 
     with config_tty() as tty:
@@ -103,7 +150,7 @@ async def image_run(env, name, args):
         sys.exit(exit_code)
 
 
-_Tag = namedtuple('_Tag', 'value created')
+_Tag = namedtuple('_Tag', 'value created id')
 
 
 @click.command('gc', help='Remove old images', cls=AsyncCommand)
@@ -114,28 +161,41 @@ async def image_gc(env, count):
         click.echo('Count should be more or equal to 0')
         sys.exit(-1)
     known_repos = {i.repository for i in env.images}
+    layers_repos = {layers_repository(repo) for repo in known_repos}
     containers = await env.docker.containers(params={'all': 'true'})
     repo_tags_used = {c['Image'] for c in containers}
 
     by_repo = defaultdict(list)
+    layers = []
+    parents = {}
     to_delete = []
 
-    images = await env.docker.images()
-    for image in images:
-        repo_tags = set(image['RepoTags'])
+    async for image in env.docker.iter_images():
+        parents[image['Id']] = image.get('ParentId')
+        repo_tags = set(image['RepoTags'] or [])
         if repo_tags == {'<none>:<none>'}:
             to_delete.append(image['Id'])
             continue
         repo_tags.difference_update(repo_tags_used)
         for repo_tag in repo_tags:
-            repo, _, tag = repo_tag.partition(':')
+            repo, _, tag = repo_tag.rpartition(':')
             if repo in known_repos:
-                by_repo[repo].append(_Tag(tag, image['Created']))
+                by_repo[repo].append(_Tag(tag, image['Created'], image['Id']))
+            elif repo in layers_repos:
+                layers.append(_Tag(repo_tag, image['Created'], image['Id']))
 
+    # layers are kept while they are used by the remaining images
+    used = set()
     for repo, tags in by_repo.items():
         latest_tags = sorted(tags, key=attrgetter('created'), reverse=True)
+        for tag in latest_tags[:count]:
+            id_ = tag.id
+            while id_ and id_ not in used:
+                used.add(id_)
+                id_ = parents.get(id_)
         for tag in latest_tags[count:]:
             to_delete.append('{}:{}'.format(repo, tag.value))
+    to_delete.extend(layer.value for layer in layers if layer.id not in used)
 
     for image in to_delete:
         await env.docker.remove_image(image)
@@ -146,8 +206,7 @@ async def _get_images_info(env):
     available = set()
     counts = Counter()
     sizes = {}
-    images = await env.docker.images()
-    for image in images:
+    async for image in env.docker.iter_images():
         available.update(image['RepoTags'])
         for repo_tag in image['RepoTags']:
             repo, _ = repo_tag.split(':')
@@ -161,9 +220,13 @@ async def _get_images_info(env):
 async def image_list(env):
     from .._requires.tabulate import tabulate
 
-    available, counts, sizes = await _get_images_info(env)
     images = sorted(env.images, key=lambda i: i.name)
-    versions = image_versions(env.images, images)
+    # hashing is done in threads, while waiting for Docker
+    (available, counts, sizes), _ = await asyncio.gather(
+        _get_images_info(env),
+        env.versions.prepare(images),
+    )
+    versions = [env.versions.version(image) for image in images]
 
     rows = []
     for image, version in zip(images, versions):
@@ -2,7 +2,7 @@ import logging
 
 from .._requires import click
 
-from ..types import Meta
+from ..types import Meta, Command
 from ..config import read_config
 from ..images import get_images
 from ..environ import Environ
@@ -35,7 +35,8 @@ class UI(click.CommandCollection):
         ctx = click.get_current_context()
         images = get_images(self._config)
         services = get_services(self._config)
-        ctx.obj = Environ(self._meta, images, services)
+        commands = [i for i in self._config if isinstance(i, Command)]
+        ctx.obj = Environ(self._meta, images, services, commands)
         log.debug('Environment configured')
 
     def _list_core_commands(self, ctx):
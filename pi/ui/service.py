@@ -1,14 +1,17 @@
 import sys
+import asyncio
+
+from itertools import chain
 
 from .._requires import click
 from .._requires.tabulate import tabulate
 
 from ..run import start_service
-from ..utils import search_container, sh_to_list
-from ..images import docker_image
+from ..utils import sh_to_list
 from ..network import ensure_network
 from ..console import pretty
-from ..services import get_volumes, service_label
+from ..services import get_volumes, service_label, namespace_labels
+from ..services import namespace_filter
 
 from .common import ExtGroup, AsyncCommand
 
@@ -23,8 +26,9 @@ async def service_start(env, name):
         sys.exit(-1)
 
     label = service_label(env.namespace, service)
-    containers = await env.docker.containers(params={'all': 'true'})
-    container = next(search_container(label, containers), None)
+    containers = await env.docker.containers(params={'all': 'true'},
+                                             filters={'label': label})
+    container = next(iter(containers), None)
     if container is not None:
         if container['State'] == 'running':
             click.echo('Service is already running')
@@ -36,7 +40,7 @@ async def service_start(env, name):
     else:
         exec_ = sh_to_list(service.exec) if service.exec else None
         args = sh_to_list(service.args) if service.args else None
-        di = docker_image(env, service.image)
+        di = env.versions.docker_image(service.image)
         await ensure_network(env.docker, env.network)
         await start_service(
             env.docker, di, args,
@@ -47,6 +51,7 @@ async def service_start(env, name):
             network=env.network,
             network_alias=service.network_name or service.name,
             label=label,
+            labels=namespace_labels(env.namespace),
         )
         click.echo('Service started')
 
@@ -61,8 +66,8 @@ async def service_stop(env, name):
         sys.exit(-1)
 
     label = service_label(env.namespace, service)
-    all_containers = await env.docker.containers(params={'all': 'true'})
-    containers = list(search_container(label, all_containers))
+    containers = await env.docker.containers(params={'all': 'true'},
+                                             filters={'label': label})
     if not containers:
         click.echo('Service was not started')
         sys.exit(-1)
@@ -78,7 +83,21 @@ async def service_stop(env, name):
 @click.command('status', help='Display services status', cls=AsyncCommand)
 @click.pass_obj
 async def service_status(env):
-    containers = await env.docker.containers(params={'all': 'true'})
+    containers = await env.docker.containers(
+        params={'all': 'true'},
+        filters={'label': namespace_filter(env.namespace)},
+    )
+    found = set(chain.from_iterable(c['Labels'] for c in containers))
+    # containers, started by previous versions, have no namespace label
+    missing = [label for label in (service_label(env.namespace, service)
+                                   for service in env.services)
+               if label not in found]
+    results = await asyncio.gather(*[
+        env.docker.containers(params={'all': 'true'},
+                              filters={'label': label})
+        for label in missing
+    ])
+    containers = list(chain(containers, *results))
 
     running = set()
     exited = set()
@@ -104,7 +123,7 @@ async def service_status(env):
             status = None
             image = None
 
-        di = docker_image(env.images, service.image)
+        di = env.versions.docker_image(service.image)
 
         if image is not None and image != di.name:
             image += ' (obsolete)'
@@ -1,9 +1,13 @@
+import os
 import sys
 import math
 import shlex
 import asyncio
+import threading
 
+from pathlib import Path
 from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
 
 
 class MessageType:
@@ -29,8 +33,9 @@ def format_size(value):
         '{{value:.{precision}f}}'
         .format(precision=precision)
         .format(value=value, unit=unit)
-        .rstrip('.0')
     )
+    if '.' in size:
+        size = size.rstrip('0').rstrip('.')
     return '{} {}'.format(size, unit)
 
 
@@ -63,12 +68,6 @@ class ImmutableDict(dict):
     clear = pop = popitem = setdefault = update = _immutable
 
 
-def search_container(label, containers):
-    for container in containers:
-        if label in container['Labels']:
-            yield container
-
-
 _unknown = object()
 
 
@@ -91,6 +90,13 @@ class SequenceMap:
         return len(self._items)
 
 
+def cache_dir(*parts):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = Path(base, 'pi', *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
 def sh_to_list(args):
     if isinstance(args, str):
         return shlex.split(args)
@@ -99,6 +105,49 @@ def sh_to_list(args):
         return args
 
 
+CPU_WORKERS_ENV = 'PI_CPU_WORKERS'
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    # modules used by CPU actions are imported once per worker
+    from . import tasks, hashing  # noqa
+
+
+def _noop():
+    pass
+
+
+def process_pool():
+    """Returns process pool, shared by all CPU-bound actions
+
+    Number of workers is configured using PI_CPU_WORKERS environment
+    variable and defaults to the number of CPUs.
+    """
+    global _process_pool
+    # also called from the executor threads, which are hashing files
+    with _process_pool_lock:
+        if _process_pool is None:
+            max_workers = (int(os.environ.get(CPU_WORKERS_ENV) or 0)
+                           or os.cpu_count() or 1)
+            _process_pool = ProcessPoolExecutor(max_workers,
+                                                initializer=_init_worker)
+            # workers are started in advance
+            for _ in range(max_workers):
+                _process_pool.submit(_noop)
+        return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
 async def terminate(task, *, wait=1):
     task.cancel()
     try:
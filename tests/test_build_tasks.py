@@ -1,15 +1,24 @@
+import io
+import os
+import asyncio
 import tarfile
+import tempfile
 
+from unittest.mock import Mock
 from contextlib import closing
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pytest
 
 from aiohttp import web
 
-from pi.types import Download, File, Bundle, Task
+from pi.types import Download, File, Bundle, Task, DockerImage, Image
 from pi.tasks import IOExecutor, CPUExecutor
 from pi.tasks import task_cmd, get_action_states
+from pi.tasks import dockerfile, build_context, build_image
+from pi.images import ImageVersions
+from pi.hashing import DigestCache
+from pi.utils import SequenceMap, process_pool, shutdown_process_pool
 
 
 def test_task_cmd():
@@ -103,3 +112,152 @@ async def test_bundle(loop):
             with tarfile.open(state.result.file.name) as tmp:
                 file_path = '{}/stub-l2/stub.txt'.format(state.result.uuid)
                 assert file_path in tmp.getnames()
+
+
+def test_dockerfile():
+    action = File('cubit.txt')
+    tasks = [
+        Task('cp {{cubit}} /etc/cubit.txt', where={'cubit': action}),
+        Task('echo "skew"', where={}),
+    ]
+    content = dockerfile(DockerImage('python:3'), tasks, {action: 'bole'})
+    assert content.splitlines() == [
+        'FROM python:3',
+        'COPY [".pi/bole", "/.pi/bole"]',
+        'RUN ["/bin/sh", "-c", "(\\ncp /.pi/bole /etc/cubit.txt\\n) '
+        '&& rm -rf /.pi"]',
+        'RUN ["/bin/sh", "-c", "(\\necho \\"skew\\"\\n) && rm -rf /.pi"]',
+    ]
+
+
+def test_build_context():
+    with tempfile.TemporaryFile() as archive:
+        with tarfile.open(fileobj=archive, mode='w:tar') as tar:
+            info = tarfile.TarInfo('bole')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'askew'))
+        with tempfile.TemporaryFile() as context:
+            build_context(context, 'FROM python:3\n', [archive])
+            context.seek(0)
+            with tarfile.open(fileobj=context) as tar:
+                assert tar.getnames() == ['Dockerfile', '.pi/bole']
+                with tar.extractfile('.pi/bole') as f:
+                    assert f.read() == b'askew'
+
+
+def test_process_pool_threads(monkeypatch):
+    monkeypatch.setenv('PI_CPU_WORKERS', '1')
+    shutdown_process_pool()
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            pools = set(executor.map(lambda _: process_pool(), range(8)))
+        assert len(pools) == 1
+    finally:
+        shutdown_process_pool()
+
+
+def test_process_pool(monkeypatch):
+    monkeypatch.setenv('PI_CPU_WORKERS', '2')
+    shutdown_process_pool()
+    try:
+        pool = process_pool()
+        assert pool is process_pool()
+        pids = {pool.submit(os.getpid).result() for _ in range(10)}
+        assert 0 < len(pids) <= 2
+        assert os.getpid() not in pids
+    finally:
+        shutdown_process_pool()
+
+
+@pytest.mark.asyncio
+async def test_build_image_cancel(loop, tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    removed = []
+    created = asyncio.Event()
+
+    class Docker:
+        async def images(self, *, filters=None):
+            return []
+
+        async def create_container(self, config):
+            created.set()
+            await asyncio.sleep(0.01)
+            return {'Id': 'lisle'}
+
+        async def remove_container(self, id_, *, params):
+            removed.append(id_)
+
+    image = Image(name='app', repository='lisp',
+                  from_=DockerImage('python:3'),
+                  _tasks=[{'run': 'make burro'}])
+    images_map = SequenceMap([image], lambda i: i.name)
+    versions = ImageVersions(images_map, digests=DigestCache(str(tmpdir)))
+    task = loop.create_task(build_image(Docker(), images_map, image,
+                                        status=Mock(), versions=versions))
+    await created.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert removed == ['lisle']
+
+
+@pytest.mark.asyncio
+async def test_build_image_cached_layers(loop, tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    image = Image(name='app', repository='lisp',
+                  from_=DockerImage('python:3'),
+                  _tasks=[{'run': 'make burro'},
+                          {'run': 'make tarot'},
+                          {'run': 'make ruble'}])
+    images_map = SequenceMap([image], lambda i: i.name)
+    versions = ImageVersions(images_map, digests=DigestCache(str(tmpdir)))
+    await versions.prepare([image])
+    layers = versions.layers(image)
+    containers = {}
+    removed = []
+    commits = []
+    tags = []
+
+    class Docker:
+        async def images(self, *, filters=None):
+            assert filters['reference'] == [layer.name for layer in layers]
+            return [{'RepoTags': [layers[0].name]}, {'RepoTags': None}]
+
+        async def create_container(self, config):
+            id_ = 'c{}'.format(len(containers))
+            containers[id_] = config['Image']
+            return {'Id': id_}
+
+        async def start(self, id_):
+            pass
+
+        async def pause(self, id_):
+            pass
+
+        async def unpause(self, id_):
+            pass
+
+        async def commit(self, *, params):
+            commits.append((containers[params['container']],
+                            '{repo}:{tag}'.format(**params)))
+
+        async def tag(self, name, *, params):
+            tags.append((name, params))
+
+        async def remove_container(self, id_, *, params):
+            removed.append(id_)
+
+    async def exec_(docker, id_, cmd):
+        assert id_ not in removed
+        return 0
+
+    monkeypatch.setattr('pi.tasks._exec', exec_)
+    assert await build_image(Docker(), images_map, image, status=Mock(),
+                             versions=versions)
+    # every task is committed from its own container, created from the
+    # previous layer, and the first task is not executed at all
+    assert commits == [(layers[0].name, layers[1].name),
+                       (layers[1].name, layers[2].name)]
+    assert sorted(removed) == sorted(containers) == ['c0', 'c1']
+    assert tags == [(layers[2].name, {'repo': 'lisp',
+                                      'tag': versions.version(image)})]
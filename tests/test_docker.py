@@ -0,0 +1,99 @@
+import asyncio
+
+from urllib.parse import unquote_plus
+
+import pytest
+
+from pi.docker import Docker
+
+
+class _Requests:
+
+    def __init__(self):
+        self.paths = []
+
+    async def get(self, path):
+        self.paths.append(path)
+        await asyncio.sleep(0)
+        return [{'Id': len(self.paths)}]
+
+    async def post(self, path, data=None):
+        return {}
+
+
+def _docker(requests):
+    docker = Docker()
+    docker._get_json_array = requests.get
+    docker._post_json = requests.post
+    return docker
+
+
+@pytest.mark.asyncio
+async def test_single_flight(loop):
+    requests = _Requests()
+    docker = _docker(requests)
+    first, second = await asyncio.gather(docker.images(), docker.images())
+    assert first is second
+    assert await docker.images() is first
+    assert requests.paths == ['/images/json']
+
+
+@pytest.mark.asyncio
+async def test_invalidate_on_mutation(loop):
+    requests = _Requests()
+    docker = _docker(requests)
+    images = await docker.images()
+    containers = await docker.containers(params={'all': 'true'})
+
+    await docker.commit(params={'container': 'nippy'})
+    assert await docker.images() is not images
+    assert await docker.containers(params={'all': 'true'}) is containers
+
+    await docker.create_container({'Image': 'fives'})
+    assert await docker.containers(params={'all': 'true'}) is not containers
+    assert requests.paths == [
+        '/images/json',
+        '/containers/json?all=true',
+        '/images/json',
+        '/containers/json?all=true',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_invalidate_on_wait(loop):
+    requests = _Requests()
+    docker = _docker(requests)
+    containers = await docker.containers(params={'all': 'true'})
+    await docker.wait('sumac')
+    assert await docker.containers(params={'all': 'true'}) is not containers
+
+
+@pytest.mark.asyncio
+async def test_failed_request_not_cached(loop):
+    calls = []
+
+    async def get(path):
+        calls.append(path)
+        if len(calls) == 1:
+            raise ValueError('aware')
+        return []
+
+    docker = Docker()
+    docker._get_json_array = get
+    with pytest.raises(ValueError):
+        await docker.images()
+    assert await docker.images() == []
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_filters(loop):
+    requests = _Requests()
+    docker = _docker(requests)
+    await docker.images(filters={'reference': ['sway:1', 'anew:2']})
+    await docker.containers(params={'all': 'true'},
+                            filters={'label': 'doubter'})
+    assert [unquote_plus(p) for p in requests.paths] == [
+        '/images/json?filters={"reference": ["sway:1", "anew:2"]}',
+        '/containers/json?all=true&filters={"label": ["doubter"]}',
+    ]
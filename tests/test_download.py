@@ -0,0 +1,207 @@
+import gzip
+import zlib
+import tarfile
+import tempfile
+
+import pytest
+
+from aiohttp import web
+
+from pi import download
+from pi.download import DownloadCache
+
+from .test_http import serve
+
+
+def _app(files, requests):
+
+    async def handle(request):
+        name = request.match_info['name']
+        requests.append((name, request.headers.get('If-None-Match')))
+        content = files[name]
+        etag = '"{}"'.format(len(content))
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.Response(body=content, headers={'ETag': etag})
+
+    app = web.Application()
+    app.router.add_get('/{name}', handle)
+    return app
+
+
+def _read(path, digest):
+    with tarfile.open(path) as tar:
+        with tar.extractfile(digest) as f:
+            return f.read()
+
+
+@pytest.mark.asyncio
+async def test_download_cache(loop, tmpdir):
+    files = {'tort': b'AbjectPreenMeekerEnquiry'}
+    requests = []
+    async with serve(_app(files, requests)) as (host, port):
+        url = 'http://{}:{}/tort'.format(host, port)
+
+        cache = DownloadCache(str(tmpdir))
+        digest, path = await cache.fetch(url)
+        assert _read(path, digest) == files['tort']
+
+        cache = DownloadCache(str(tmpdir))
+        assert await cache.fetch(url) == (digest, path)
+
+    assert requests == [('tort', None), ('tort', '"24"')]
+
+
+@pytest.mark.asyncio
+async def test_download_cache_eviction(loop, tmpdir):
+    files = {'hake': b'x' * 2000, 'cove': b'y' * 3000}
+    requests = []
+    async with serve(_app(files, requests)) as (host, port):
+        url = 'http://{}:{}/{{}}'.format(host, port)
+
+        cache = DownloadCache(str(tmpdir), max_size=10000)
+        hake_digest, hake_path = await cache.fetch(url.format('hake'))
+        cove_digest, cove_path = await cache.fetch(url.format('cove'))
+        # files returned by the cache are not evicted by it
+        assert hake_path.exists()
+        assert cove_path.exists()
+
+        other = DownloadCache(str(tmpdir), max_size=10000)
+        await other.fetch(url.format('cove'))
+        assert not hake_path.exists()
+        assert cove_path.exists()
+
+        await cache.fetch(url.format('hake'))
+    assert requests == [
+        ('hake', None), ('cove', None), ('cove', '"3000"'), ('hake', None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_download_cache_shared(loop, tmpdir):
+    files = {'gust': b'x' * 2000, 'yawl': b'y' * 3000}
+    requests = []
+    async with serve(_app(files, requests)) as (host, port):
+        url = 'http://{}:{}/{{}}'.format(host, port)
+
+        # two processes, using the same cache
+        first = DownloadCache(str(tmpdir))
+        second = DownloadCache(str(tmpdir))
+        gust_digest, gust_path = await first.fetch(url.format('gust'))
+        yawl_digest, _ = await second.fetch(url.format('yawl'))
+        index = first._read_index()
+        assert set(index['blobs']) == {gust_digest, yawl_digest}
+
+        # url entry without blob entry is a miss
+        del index['blobs'][gust_digest]
+        first._write_index(index)
+        result = await first.fetch(url.format('gust'))
+        assert result == (gust_digest, gust_path)
+    assert requests == [('gust', None), ('yawl', None), ('gust', None)]
+
+
+@pytest.mark.asyncio
+async def test_fetch_segments(loop, tmpdir, monkeypatch):
+    monkeypatch.setattr(download, 'MIN_SEGMENT_SIZE', 1000)
+    content = bytes(range(256)) * 20
+    path = tmpdir.join('moppet')
+    path.write_binary(content)
+    ranges = []
+
+    async def handle(request):
+        ranges.append(request.headers.get('Range'))
+        return web.FileResponse(str(path))
+
+    app = web.Application()
+    app.router.add_get('/moppet', handle)
+    async with serve(app) as (host, port):
+        url = 'http://{}:{}/moppet'.format(host, port)
+        with tempfile.TemporaryFile() as output:
+            await download.fetch(url, output)
+            output.seek(0)
+            assert output.read() == content
+    assert sorted(ranges, key=str) == [
+        None, 'bytes=1280-2559', 'bytes=2560-3839', 'bytes=3840-5119',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_fetch_resume(loop, tmpdir):
+    content = bytes(range(256)) * 20
+    path = tmpdir.join('lanky')
+    path.write_binary(content)
+    ranges = []
+
+    async def handle(request):
+        ranges.append(request.headers.get('Range'))
+        if len(ranges) == 1:
+            response = web.StreamResponse(headers={
+                'Accept-Ranges': 'bytes',
+                'Content-Length': str(len(content)),
+            })
+            await response.prepare(request)
+            await response.write(content[:1000])
+            request.transport.close()
+            return response
+        return web.FileResponse(str(path))
+
+    app = web.Application()
+    app.router.add_get('/lanky', handle)
+    async with serve(app) as (host, port):
+        url = 'http://{}:{}/lanky'.format(host, port)
+        with tempfile.TemporaryFile() as output:
+            await download.fetch(url, output)
+            output.seek(0)
+            assert output.read() == content
+    assert ranges == [None, 'bytes=1000-5119']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('encoding, compress', [
+    ('gzip', gzip.compress),
+    ('deflate', zlib.compress),
+])
+async def test_fetch_compressed(loop, encoding, compress):
+    content = b'BurrowedFlues' * 10000
+    accept_encoding = []
+
+    async def handle(request):
+        accept_encoding.append(request.headers.get('Accept-Encoding'))
+        return web.Response(body=compress(content),
+                            headers={'Content-Encoding': encoding})
+
+    app = web.Application()
+    app.router.add_get('/', handle)
+    async with serve(app) as (host, port):
+        with tempfile.TemporaryFile() as output:
+            url = 'http://{}:{}/'.format(host, port)
+            await download.fetch(url, output)
+            output.seek(0)
+            assert output.read() == content
+    assert accept_encoding == ['gzip, deflate']
+
+
+@pytest.mark.asyncio
+async def test_fetch_keep_alive(loop):
+    peers = []
+
+    async def handle(request):
+        peers.append(request.transport.get_extra_info('peername'))
+        if request.match_info['name'] == 'hop':
+            raise web.HTTPFound('/bloke')
+        return web.Response(body=b'tipsy')
+
+    app = web.Application()
+    app.router.add_get('/{name}', handle)
+    async with serve(app) as (host, port):
+        try:
+            for name in ['hop', 'bloke']:
+                with tempfile.TemporaryFile() as output:
+                    url = 'http://{}:{}/{}'.format(host, port, name)
+                    await download.fetch(url, output)
+                    output.seek(0)
+                    assert output.read() == b'tipsy'
+        finally:
+            download.close_pools()
+    assert len(peers) == 3
+    assert len(set(peers)) == 1
@@ -0,0 +1,112 @@
+import os
+
+from pi import hashing
+from pi.hashing import DigestCache
+
+
+def _count_digests(monkeypatch):
+    paths = []
+    file_digest = hashing.file_digest
+
+    def digest(path):
+        paths.append(path)
+        return file_digest(path)
+
+    monkeypatch.setattr(hashing, 'file_digest', digest)
+    return paths
+
+
+def _touch(path, content, age):
+    path.write_binary(content)
+    mtime = path.stat().mtime - age
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_digest_cache(tmpdir, monkeypatch):
+    paths = _count_digests(monkeypatch)
+    path = tmpdir.join('glint')
+    _touch(path, b'AbaftSwellOdder', age=60)
+
+    cache = DigestCache(str(tmpdir))
+    digest = cache.file_digest(str(path))
+    assert cache.file_digest(str(path)) == digest
+    cache.save()
+    assert DigestCache(str(tmpdir)).file_digest(str(path)) == digest
+    assert len(paths) == 1
+
+    _touch(path, b'AbaftSwellOdder!', age=60)
+    assert cache.file_digest(str(path)) != digest
+    assert len(paths) == 2
+
+
+def test_digest_cache_racy(tmpdir, monkeypatch):
+    paths = _count_digests(monkeypatch)
+    path = tmpdir.join('sham')
+    _touch(path, b'', age=0)
+
+    cache = DigestCache(str(tmpdir))
+    digest = cache.file_digest(str(path))
+    assert digest == hashing.hashlib.sha256(b'').hexdigest()
+    assert cache.file_digest(str(path)) == digest
+    assert len(paths) == 2
+
+
+def _tree(tmpdir):
+    for path, content in [
+        ('tart/rind', b'BuskDrumWrinkle'),
+        ('tart/beau/nice', b'SnoopyRhymesIllumine'),
+        ('bail', b''),
+    ]:
+        file_path = tmpdir.join(path)
+        file_path.dirpath().ensure_dir()
+        _touch(file_path, content, age=60)
+    return tmpdir
+
+
+def test_tree_digest(tmpdir, monkeypatch):
+    paths = _count_digests(monkeypatch)
+    tree = _tree(tmpdir.mkdir('tree'))
+
+    cache = DigestCache(str(tmpdir))
+    digest = cache.tree_digest(str(tree))
+    assert len(paths) == 3
+    cache.save()
+
+    cache = DigestCache(str(tmpdir))
+    assert cache.tree_digest(str(tree)) == digest
+    assert len(paths) == 3
+
+    _touch(tree.join('tart/beau/nice'), b'SnoopyRhymes', age=60)
+    changed_digest = cache.tree_digest(str(tree))
+    assert changed_digest != digest
+    assert paths[3:] == [str(tree.join('tart/beau/nice'))]
+
+    tree.join('tart/beau/nice').rename(tree.join('tart/beau/node'))
+    assert cache.tree_digest(str(tree)) != changed_digest
+    assert paths[4:] == [str(tree.join('tart/beau/node'))]
+
+
+def test_tree_digest_parallel(tmpdir, monkeypatch):
+    tree = _tree(tmpdir.mkdir('tree'))
+    digest = DigestCache(str(tmpdir.mkdir('serial'))).tree_digest(str(tree))
+    monkeypatch.setattr(hashing, 'PARALLEL_THRESHOLD', 1)
+    cache = DigestCache(str(tmpdir.mkdir('parallel')))
+    assert cache.tree_digest(str(tree)) == digest
+
+
+def test_tree_digest_special_files(tmpdir, monkeypatch):
+    paths = _count_digests(monkeypatch)
+    tree = _tree(tmpdir.mkdir('tree'))
+    tree.join('tart/nitty').mksymlinkto('rind')
+    tree.join('dangle').mksymlinkto('missing')
+    os.mkfifo(str(tree.join('pipe')))
+
+    cache = DigestCache(str(tmpdir))
+    digest = cache.tree_digest(str(tree))
+    assert sorted(paths) == sorted(str(tree.join(p))
+                                   for p in ['tart/rind', 'tart/beau/nice',
+                                             'bail'])
+
+    tree.join('dangle').remove()
+    tree.join('dangle').mksymlinkto('missed')
+    assert cache.tree_digest(str(tree)) != digest
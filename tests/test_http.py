@@ -0,0 +1,205 @@
+import ssl
+import json
+import shutil
+import subprocess
+
+from functools import partial
+from unittest.mock import Mock
+from contextlib import asynccontextmanager
+
+import pytest
+
+from aiohttp import web
+
+from pi import http
+from pi.http import ConnectionPool, JSONArrayDecoder, NDJSONDecoder, Stream
+from pi.http import open_tcp
+
+
+@asynccontextmanager
+async def serve(app, *, host='127.0.0.1', port=6790, ssl_context=None):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+    await site.start()
+    try:
+        yield host, port
+    finally:
+        await runner.cleanup()
+
+
+async def _get(pool, path):
+    async with pool.connect() as stream:
+        await stream.send_request('GET', path, [('host', 'localhost')])
+        response = await stream.recv_response()
+        assert response.status_code == 200
+        content_length = int(response.headers[b'content-length'])
+        return await stream.recv_data(content_length)
+
+
+@pytest.mark.asyncio
+async def test_connection_pool_reuse(loop):
+    peers = []
+
+    async def handle(request):
+        peers.append(request.transport.get_extra_info('peername'))
+        return web.Response(body=b'ruddy')
+
+    app = web.Application()
+    app.router.add_get('/', handle)
+    async with serve(app) as (host, port):
+        pool = ConnectionPool(partial(open_tcp, host, port))
+        try:
+            assert await _get(pool, '/') == b'ruddy'
+            assert await _get(pool, '/') == b'ruddy'
+        finally:
+            pool.close()
+    assert len(peers) == 2
+    assert peers[0] == peers[1]
+
+
+@pytest.mark.asyncio
+async def test_connection_pool_incomplete(loop):
+    async def handle(_):
+        return web.Response(body=b'scamp')
+
+    app = web.Application()
+    app.router.add_get('/', handle)
+    async with serve(app) as (host, port):
+        pool = ConnectionPool(partial(open_tcp, host, port))
+        try:
+            protocol = await pool.acquire()
+            await protocol.stream.send_request('GET', '/', [
+                ('host', 'localhost'),
+            ])
+            pool.release(protocol)
+            assert protocol.transport.is_closing()
+            assert await _get(pool, '/') == b'scamp'
+        finally:
+            pool.close()
+
+
+def _decode(*chunks):
+    decoder = JSONArrayDecoder()
+    items = []
+    for chunk in chunks:
+        items.extend(decoder.feed(chunk))
+    items.extend(decoder.close())
+    return items
+
+
+def test_json_array_decoder():
+    value = [{'RepoTags': ['caf\u00e9:1']}, 123, 'gummed', [], True, None]
+    data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+    assert _decode(data) == value
+    for i in range(len(data) + 1):
+        assert _decode(data[:i], data[i:]) == value
+    assert _decode(b' [ ] ') == []
+
+
+def test_json_array_decoder_numbers():
+    value = [1.5, -0.5, 2e10, -3.25E-4, 0, 120, False]
+    data = json.dumps(value).replace(' ', '').encode('utf-8')
+    for i in range(len(data) + 1):
+        assert _decode(data[:i], data[i:]) == value
+        for j in range(i, len(data) + 1):
+            assert _decode(data[:i], data[i:j], data[j:]) == value
+    assert _decode(*[data[i:i + 1] for i in range(len(data))]) == value
+
+
+def test_json_array_decoder_incremental():
+    decoder = JSONArrayDecoder()
+    assert decoder.feed(b'[{"a": 1}, {"b"') == [{'a': 1}]
+    assert decoder.feed(b': 2}, 3') == [{'b': 2}]
+    assert decoder.feed(b'4]') == [34]
+    assert decoder.close() == []
+
+
+def test_json_array_decoder_incomplete():
+    decoder = JSONArrayDecoder()
+    decoder.feed(b'[{"a": 1}')
+    with pytest.raises(ValueError):
+        decoder.close()
+
+
+def test_ndjson_decoder():
+    value = [{'status': 'caf\u00e9'}, {'id': 'a', 'status': 'Pushed'}]
+    data = b''.join(json.dumps(item, ensure_ascii=False).encode('utf-8')
+                    + b'\r\n' for item in value)
+    for i in range(len(data) + 1):
+        decoder = NDJSONDecoder()
+        items = decoder.feed(data[:i]) + decoder.feed(data[i:])
+        assert items + decoder.close() == value
+
+
+def test_ndjson_decoder_incomplete():
+    decoder = NDJSONDecoder()
+    assert decoder.feed(b'{"a": 1}\n\n{"b"') == [{'a': 1}]
+    with pytest.raises(ValueError):
+        decoder.close()
+
+
+@pytest.mark.asyncio
+async def test_stream_flow_control(loop):
+    transport = Mock()
+    stream = Stream(None, None, transport)
+    stream.set_buffer_limits(high=10, low=4)
+    for _ in range(3):
+        stream.__data__(Mock(data=b'tort'))
+    assert transport.pause_reading.call_count == 1
+    assert stream.stats.buffered == 12
+
+    chunks = stream.recv_data_chunked()
+    assert await chunks.__anext__() == b'tort'
+    assert not transport.resume_reading.called
+    assert await chunks.__anext__() == b'tort'
+    assert transport.resume_reading.call_count == 1
+
+    stream.__data__(Mock(data=b'cruel'))
+    stream.__end__()
+    assert [c async for c in chunks] == [b'tort', b'cruel']
+    assert stream.stats == (17, 0, 12, 1)
+
+
+@pytest.fixture()
+def certificate(tmpdir):
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is not available')
+    cert, key = str(tmpdir.join('cert.pem')), str(tmpdir.join('key.pem'))
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-days', '1', '-subj', '/CN=localhost', '-keyout', key, '-out', cert,
+        '-addext', 'subjectAltName=DNS:localhost',
+    ], check=True, capture_output=True)
+    http.ssl_context.cache_clear()
+    http.ssl_context().load_verify_locations(cert)
+    yield cert, key
+    http.ssl_context.cache_clear()
+    http._tls_sessions.clear()
+
+
+@pytest.mark.asyncio
+async def test_tls_session_resumption(loop, certificate):
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(*certificate)
+
+    async def handle(_):
+        return web.Response(body=b'sepal')
+
+    app = web.Application()
+    app.router.add_get('/', handle)
+    reused = []
+    async with serve(app, ssl_context=server_context) as (_, port):
+        for _ in range(2):
+            protocol = await open_tcp('localhost', port, secure=True)
+            try:
+                stream = protocol.stream
+                await stream.send_request('GET', '/', [('host', 'localhost')])
+                assert (await stream.recv_response()).status_code == 200
+                assert await stream.recv_data(5) == b'sepal'
+                ssl_object = protocol.transport.get_extra_info('ssl_object')
+                reused.append(ssl_object.session_reused)
+            finally:
+                protocol.transport.close()
+    assert http.ssl_context() is http.ssl_context()
+    assert reused == [False, True]
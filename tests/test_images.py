@@ -0,0 +1,107 @@
+import json
+
+from unittest.mock import Mock
+
+import pytest
+
+from pi import images
+from pi.types import Image, DockerImage
+from pi.utils import SequenceMap
+from pi.images import ImageVersions, Hasher, pull
+from pi.hashing import DigestCache
+
+
+def test_image_versions(tmpdir, monkeypatch):
+    visited = []
+    visit_image = Hasher.visit_image
+
+    def visit(self, obj):
+        visited.append(obj.name)
+        return visit_image(self, obj)
+
+    monkeypatch.setattr(Hasher, 'visit_image', visit)
+    images_map = SequenceMap([
+        Image(name='base', repository='fodder',
+              from_=DockerImage('python:3')),
+        Image(name='app', repository='fodder', from_='base'),
+        Image(name='test', repository='fodder', from_='app'),
+    ], lambda i: i.name)
+
+    digests = DigestCache(str(tmpdir))
+    versions = ImageVersions(images_map, digests=digests)
+    test = versions.docker_image('test')
+    app = versions.docker_image('app')
+    assert visited == ['base', 'app', 'test']
+    assert test.name.startswith('fodder:')
+    assert test != app
+    assert versions.docker_image(DockerImage('lathe:1')).name == 'lathe:1'
+    other = ImageVersions(images_map, digests=digests)
+    assert other.version(images_map.get('test')) == test.name.split(':')[1]
+
+
+@pytest.mark.asyncio
+async def test_image_versions_prepare(loop, tmpdir):
+    images_map = SequenceMap([
+        Image(name='base', repository='reeve',
+              from_=DockerImage('python:3')),
+        Image(name='app', repository='reeve', from_='base'),
+        Image(name='tool', repository='reeve', from_='base'),
+    ], lambda i: i.name)
+    versions = ImageVersions(images_map, digests=DigestCache(str(tmpdir)))
+    await versions.prepare(images_map)
+    assert versions._hashes.keys() == {'base', 'app', 'tool'}
+
+    expected = ImageVersions(images_map, digests=DigestCache(str(tmpdir)))
+    assert all(versions.version(image) == expected.version(image)
+               for image in images_map)
+
+
+def test_image_layers(tmpdir):
+    def layers(*runs):
+        image = Image(name='app', repository='lisp',
+                      from_=DockerImage('python:3'),
+                      _tasks=[{'run': run} for run in runs])
+        images_map = SequenceMap([image], lambda i: i.name)
+        versions = ImageVersions(images_map,
+                                 digests=DigestCache(str(tmpdir)))
+        return [layer.name for layer in versions.layers(image)]
+
+    first = layers('pip install lunar', 'make cultus', 'make burro')
+    second = layers('pip install lunar', 'make cultus', 'make lucre')
+    assert all(layer.startswith('lisp-layers:') for layer in first)
+    assert len(set(first)) == 3
+    assert first[:2] == second[:2]
+    assert first[2] != second[2]
+    assert layers('make cultus', 'pip install lunar')[0] != first[1]
+
+
+@pytest.mark.asyncio
+async def test_pull_progress(loop, monkeypatch):
+    events = [
+        {'status': 'Pulling from library/python', 'id': '3'},
+        {'status': 'Downloading', 'id': 'a1',
+         'progressDetail': {'current': 1000, 'total': 4000}},
+        {'status': 'Downloading', 'id': 'b2',
+         'progressDetail': {'current': 1000, 'total': 6000}},
+        {'status': 'Download complete', 'id': 'a1'},
+    ]
+    data = b''.join(json.dumps(event).encode('utf-8') + b'\r\n'
+                    for event in events)
+
+    class Docker:
+        async def create_image(self, *, params):
+            # documents are split between chunks
+            for i in range(0, len(data), 7):
+                yield data[i:i + 7]
+
+    titles = []
+    status = Mock()
+    status.update.side_effect = lambda key, title: titles.append(title)
+    monotonic = iter([0, 1, 2, 3]).__next__
+    monkeypatch.setattr(images, 'time', Mock(monotonic=monotonic))
+    assert await pull(Docker(), DockerImage('python:3'), status=status)
+    assert [call[0][1] for call in status.add_step.call_args_list] == [
+        '  [a1] Downloading', '  [b2] Downloading',
+    ]
+    assert titles[-1] == ('=> Pulling image python:3 '
+                          '(5 kB / 10 kB, 1.667 kB/s, ETA 3s)')
@@ -0,0 +1,75 @@
+import pytest
+
+from aiohttp import web
+
+from pi.types import DockerImage
+from pi.registry import Registry, MissingCache, _split_name
+
+from .test_http import serve
+
+
+@pytest.mark.parametrize('name, result', [
+    ('python:3', ('docker.io', 'library/python', '3')),
+    ('user/repo', ('docker.io', 'user/repo', 'latest')),
+    ('quay.io/user/repo:1', ('quay.io', 'user/repo', '1')),
+    ('localhost:5000/repo', ('localhost:5000', 'repo', 'latest')),
+])
+def test_split_name(name, result):
+    assert _split_name(name) == result
+
+
+def _registry_app(host, port, tags, requests):
+
+    async def token(request):
+        assert request.query['scope'] == 'repository:rook:pull'
+        return web.json_response({'token': 'letup'})
+
+    async def manifest(request):
+        requests.append((request.method, request.match_info['tag']))
+        if request.headers.get('Authorization') != 'Bearer letup':
+            realm = 'http://{}:{}/token'.format(host, port)
+            raise web.HTTPUnauthorized(headers={
+                'WWW-Authenticate': (
+                    'Bearer realm="{}",service="fake",'
+                    'scope="repository:rook:pull"'.format(realm)
+                ),
+            })
+        if request.match_info['tag'] not in tags:
+            raise web.HTTPNotFound()
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get('/token', token)
+    app.router.add_route('HEAD', '/v2/rook/manifests/{tag}', manifest)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_exists(loop, tmpdir):
+    requests = []
+    host, port = '127.0.0.1', 6790
+    async with serve(_registry_app(host, port, {'1'}, requests)):
+        missing = MissingCache(str(tmpdir))
+        registry = Registry(config={}, missing=missing)
+        name = '{}:{}/rook:{{}}'.format(host, port)
+        assert await registry.exists(DockerImage(name.format(1))) is True
+        assert await registry.exists(DockerImage(name.format(2))) is False
+        assert requests == [('HEAD', '1'), ('HEAD', '1'), ('HEAD', '2')]
+
+        registry = Registry(config={}, missing=MissingCache(str(tmpdir)))
+        assert await registry.exists(DockerImage(name.format(2))) is False
+        assert len(requests) == 3
+
+    registry = Registry(config={}, missing=MissingCache(str(tmpdir), ttl=0))
+    assert await registry.exists(DockerImage(name.format(2))) is None
+
+
+def test_missing_cache_ttl(tmpdir, monkeypatch):
+    cache = MissingCache(str(tmpdir), ttl=60)
+    monkeypatch.setattr('time.time', lambda: 1000)
+    cache.add('rook:1')
+    assert 'rook:1' in cache
+    monkeypatch.setattr('time.time', lambda: 1060)
+    assert 'rook:1' not in cache
+    cache.add('rook:2')
+    assert MissingCache(str(tmpdir))._index == {'rook:2': 1060}
@@ -0,0 +1,164 @@
+import asyncio
+
+from unittest.mock import Mock
+
+import pytest
+
+from pi import resolve as resolve_module
+from pi.types import Command, DockerImage, Image, Service
+from pi.resolve import resolve, Scheduler, Report
+
+
+class _Docker:
+
+    async def images(self, *, filters=None):
+        return []
+
+
+@pytest.mark.asyncio
+async def test_concurrent_pulls(loop, monkeypatch):
+    running = []
+    max_running = []
+
+    async def pull(docker, docker_image, *, status):
+        running.append(docker_image)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(docker_image)
+        return True
+
+    monkeypatch.setattr(resolve_module.images, 'pull', pull)
+    services_map = {
+        name: Service(name=name, image=DockerImage(name), requires=[])
+        for name in ['oaken:1', 'mural:1', 'gibes:1']
+    }
+    cmd = Command(name='drily', image=DockerImage('drily:1'), run='sh',
+                  requires=list(services_map))
+    failed = await resolve(_Docker(), {}, services_map, cmd, status=Mock(),
+                           pull=True, pull_jobs=4)
+    assert failed == []
+    assert max(max_running) == 4
+
+
+@pytest.mark.asyncio
+async def test_speculative_build(loop, monkeypatch):
+    cancelled = []
+
+    async def pull(docker, docker_image, *, status):
+        if docker_image.name == 'python:3':
+            return True
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(docker_image)
+            raise
+        return True
+
+    built = []
+
+    async def build_image(docker, images_map, image, *, status, **kwargs):
+        built.append(image.name)
+        return True
+
+    monkeypatch.setattr(resolve_module.images, 'pull', pull)
+    monkeypatch.setattr(resolve_module, 'build_image', build_image)
+    image = Image(name='slate', repository='slate',
+                  from_=DockerImage('python:3'))
+    failed = await resolve(_Docker(), {'slate': image}, {}, image,
+                           status=Mock(), pull=True, build=True,
+                           speculate_after=0.01)
+    assert failed == []
+    assert built == ['slate']
+    assert [i.name.partition(':')[0] for i in cancelled] == ['slate']
+
+
+@pytest.mark.asyncio
+async def test_registry_missing(loop, monkeypatch):
+    pulled = []
+
+    async def pull(docker, docker_image, *, status):
+        pulled.append(docker_image.name)
+        return True
+
+    async def build_image(docker, images_map, image, *, status, **kwargs):
+        return True
+
+    discarded = []
+
+    class Registry:
+        async def exists(self, docker_image):
+            return False
+
+        def discard_missing(self, docker_image):
+            discarded.append(docker_image.name)
+
+    monkeypatch.setattr(resolve_module.images, 'pull', pull)
+    monkeypatch.setattr(resolve_module, 'build_image', build_image)
+    image = Image(name='stoat', repository='stoat',
+                  from_=DockerImage('python:3'))
+    failed = await resolve(_Docker(), {'stoat': image}, {}, image,
+                           status=Mock(), pull=True, build=True,
+                           registry=Registry())
+    assert failed == []
+    # python:3 can't be built, so it is pulled anyway
+    assert pulled == ['python:3']
+    assert discarded == ['python:3']
+
+
+@pytest.mark.asyncio
+async def test_resolve_all(loop, monkeypatch):
+
+    async def pull(docker, docker_image, *, status):
+        return docker_image.name != 'lynx:1'
+
+    monkeypatch.setattr(resolve_module.images, 'pull', pull)
+    service = Service(name='heron', image=DockerImage('heron:1'), requires=[])
+    cmd = Command(name='grebe', image=DockerImage('lynx:1'), run='sh',
+                  requires=['heron'])
+    report = Report()
+    failed = await resolve(_Docker(), {}, {'heron': service},
+                           [service, cmd], status=Mock(), pull=True,
+                           report=report)
+    assert [dep.docker_image.name for dep in failed] == ['lynx:1']
+    assert sorted((job['image'], job['job'], job['result'])
+                  for job in report.jobs) == [
+        ('heron:1', 'pull', 'done'),
+        ('lynx:1', 'pull', 'failed'),
+    ]
+
+
+def _deps(**parents):
+    return {name: set(value) for name, value in parents.items()}
+
+
+def test_scheduler_critical_path():
+    scheduler = Scheduler(_deps(
+        base=[], app=['base'], test=['app'], docs=[], lint=['docs'],
+        tool=[],
+    ))
+    assert scheduler.pop_ready() == ['base', 'docs', 'tool']
+    assert scheduler.pop_ready() == []
+
+    scheduler.done('tool')
+    scheduler.done('docs')
+    assert scheduler.pop_ready() == ['lint']
+    scheduler.done('base')
+    assert scheduler.pop_ready() == ['app']
+    scheduler.done('lint')
+    scheduler.done('app')
+    assert scheduler.pop_ready() == ['test']
+    assert scheduler.active
+    scheduler.done('test')
+    assert not scheduler.active
+
+
+def test_scheduler_failed():
+    scheduler = Scheduler(_deps(
+        base=[], app=['base'], test=['app', 'tool'], tool=[],
+    ))
+    assert scheduler.pop_ready() == ['base', 'tool']
+    assert scheduler.failed('base') == ['base', 'app', 'test']
+    assert scheduler.active
+    scheduler.done('tool')
+    assert scheduler.pop_ready() == []
+    assert not scheduler.active
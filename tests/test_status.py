@@ -0,0 +1,66 @@
+import io
+import re
+
+import pytest
+
+from pi.status import Status
+
+
+_ESC_RE = re.compile('\x1b\\[(\\d+)([AB])|\x1b\\[2K\r|\n|[^\x1b\n]+')
+
+
+def _screen(output):
+    lines = ['']
+    row = 0
+    for match in _ESC_RE.finditer(output):
+        if match.group(2) == 'A':
+            row -= int(match.group(1))
+        elif match.group(2) == 'B':
+            row += int(match.group(1))
+        elif match.group() == '\x1b[2K\r':
+            lines[row] = ''
+        elif match.group() == '\n':
+            row += 1
+            if row == len(lines):
+                lines.append('')
+        else:
+            lines[row] += match.group()
+    return lines
+
+
+def test_tty():
+    output = io.StringIO()
+    with Status(output=output, tty=True) as status:
+        rift = status.add_task('rift')
+        mitt = status.add_task('mitt')
+        step = status.add_step(rift, '  tepid')
+        status.add_step(mitt, '  spoil')
+        status.update(step, '  sway')
+    assert _screen(output.getvalue()) == [
+        'rift', '  sway', 'mitt', '  spoil', '',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_frames(loop):
+    output = io.StringIO()
+    with Status(output=output, tty=True) as status:
+        task = status.add_task('fume')
+        step = status.add_step(task, '  0')
+        for i in range(100):
+            status.update(step, '  {}'.format(i))
+        # nothing is rendered until the next frame
+        assert output.getvalue() == ''
+    assert '  50' not in output.getvalue()
+    assert _screen(output.getvalue()) == ['fume', '  99', '']
+
+
+@pytest.mark.asyncio
+async def test_plain(loop):
+    output = io.StringIO()
+    with Status(output=output) as status:
+        task = status.add_task('glib')
+        step = status.add_step(task, '  ploy')
+        status.update(step, '  cusp')
+        status.update(task, 'glib')
+    assert output.getvalue() == 'glib\n  cusp\n'
@@ -0,0 +1,39 @@
+from unittest.mock import Mock
+
+from pi._requires.click.testing import CliRunner
+
+from pi.types import Service, DockerImage
+from pi.utils import SequenceMap
+from pi.ui.service import service_status
+
+
+def test_service_status():
+    containers = {
+        'pi-namespace=unco': [{'State': 'running', 'Image': 'redis:5',
+                               'Labels': {'unco-redis': '',
+                                          'pi-namespace': 'unco'}}],
+        # started before services were labeled with their namespace
+        'unco-mongo': [{'State': 'exited', 'Image': 'mongo:4',
+                        'Labels': {'unco-mongo': ''}}],
+    }
+    queries = []
+
+    class Docker:
+        async def containers(self, *, params, filters):
+            queries.append(filters['label'])
+            return containers.get(filters['label'], [])
+
+    env = Mock(namespace='unco', docker=Docker(), services=SequenceMap([
+        Service(name='redis', image=DockerImage('redis:5')),
+        Service(name='mongo', image=DockerImage('mongo:4')),
+        Service(name='nginx', image=DockerImage('nginx:1')),
+    ], lambda i: i.name))
+    env.versions.docker_image = lambda image: image
+    result = CliRunner().invoke(service_status, obj=env)
+    assert result.exit_code == 0, result.output
+    rows = [line.split() for line in result.output.splitlines()[2:]]
+    assert [row[0] for row in rows] == ['redis', 'mongo', 'nginx']
+    assert 'running' in rows[0][1] and rows[0][2] == 'redis:5'
+    assert 'stopped' in rows[1][1] and rows[1][2] == 'mongo:4'
+    assert rows[2] == ['nginx']
+    assert queries == ['pi-namespace=unco', 'unco-mongo', 'unco-nginx']